@@ -7,8 +7,16 @@ from datetime import datetime
 import pandas as pd
 import matplotlib.pyplot as plt
 import time
-from utils import light_tagger, tag, reverse_tag
+from utils import light_tagger, light_tagger_batch, language_tag_fields, document_tags, text_key, prompt_document
+from firestore_utils import PendingPool, WriteBehindQueue, review_writes, stale_write_checks, pending_candidates, claim_document, renew_lease, find_decided_duplicates, find_by_text_keys, auto_sync_duplicate, add_review_stats, create_documents, read_counter, read_summary
 import random
+import threading
+import queue
+import urllib.request
+import uuid
+from journal import ReviewJournal, apply_entry, replay_entry
+from mirror import ReviewMirror
+from word_tagger import word_tagger
 
 
 # dotenv.load_dotenv()
@@ -17,6 +25,12 @@ openai_api_key = os.environ['openai_key']
 emotions = ["Happy", "Sad", "Angry", "Neutral", "Surprised", "Fearful", "Disgusted"]
 nameofcollection = "stage_thirty_reviews"
 domanins = ['general', 'family', 'technology', 'education', 'politics', 'health', 'law', 'tourism','agriculture', 'sports']
+cache_ttl = 60  # Seconds a session reuses its sidebar and analytics reads before querying again
+prefetch_depth = 3  # Number of review items each session keeps claimed and ready in the background
+
+# Fields each read path uses; queries project to these instead of downloading whole documents
+review_item_fields = ["CodeSwitchedText", "OriginalText", "CreatorName", "domain", "Audio_link", "text_key", "auto_language_tags", "Status", "reviewer", "pulled", "multiplicity"]
+history_fields = ["OriginalText", "CodeSwitchedText", "reviewed_text", "Status", "Timestamp", "language_tags", "language_tags_rle", "emotions", "domain", "pulled"]
 
 
 # Initialize Firebase if it hasn't been initialized yet
@@ -27,147 +41,267 @@ if not _apps:
 
 db = firestore.client()
 
-# Function to load the next review item from a batch of 20 random documents
-def load_next_text():
-    # Fetch a batch of 20 documents where Status is "pending"
-    docs = db.collection(nameofcollection).where("Status", "==", "pending").limit(20).stream()
-
-    # Convert Firestore documents to a list
-    doc_list = [doc for doc in docs]
-
-    # If there are any documents available
-    if doc_list:
-        # Randomly pick one document
-        random_doc = random.choice(doc_list)
-        doc_id = random_doc.id
-        doc_data = random_doc.to_dict()
-
-        # --- NEW CHECK START ---
-        # Before showing this, check if ANY document with this EXACT text 
-        # has already been approved/edited (by someone else just now)
-        already_done = db.collection(nameofcollection)\
-            .where("CodeSwitchedText", "==", doc_data["CodeSwitchedText"].strip())\
-            .where("Status", "in", ["approve", "edit", "reject"])\
-            .limit(1).get()
-            
-        if already_done:
-            # If we found a completed version, update THIS current doc automatically
-            # and skip to the next random one so the user doesn't see it.
-            existing_data = already_done[0].to_dict()
-            db.collection(nameofcollection).document(doc_id).update({
-                "Status": existing_data["Status"],
-                "reviewed_text": existing_data["reviewed_text"],
-                "reviewer": "System-AutoSync",
-                "Timestamp": datetime.utcnow()
-            })
-            return load_next_text() # Recursively look for a truly unreviewed one
-        # --- NEW CHECK END ---
-
-        return doc_id, doc_data
+# One listener-backed pool of pending documents per server process, shared by all sessions
+@st.cache_resource
+def get_pending_pool():
+    return PendingPool(db, nameofcollection)
+
+pending_pool = get_pending_pool()
+
+# One write-behind queue per server process; each reviewer only sees their own items
+@st.cache_resource
+def get_write_queue():
+    return WriteBehindQueue()
+
+write_queue = get_write_queue()
+
+# Local write-ahead journal; whatever a previous run left unapplied is replayed in the background
+journal_handlers = review_writes(db, nameofcollection)
+
+@st.cache_resource
+def get_journal():
+    journal = ReviewJournal(f"{nameofcollection}_journal.sqlite")
+    # Entries overtaken by newer decisions are abandoned rather than applied on top of them
+    stale_checks = stale_write_checks(db, nameofcollection)
+    for entry in journal.unapplied():
+        write_queue.submit(entry["owner"], f"Replay of journal entry {entry['id']}",
+                           replay_entry, journal, journal_handlers, stale_checks, entry, ref=entry["id"])
+    return journal
+
+journal = get_journal()
+
+# Local mirror of the collection for analytics, shared by all sessions
+@st.cache_resource
+def get_review_mirror():
+    return ReviewMirror(f"{nameofcollection}_mirror.sqlite")
+
+review_mirror = get_review_mirror()
+
+# Function to claim the next review item for the reviewer from a batch of pending documents
+def load_next_text(claimant):
+    # A few rounds at most: each round auto-syncs every already-decided candidate it finds
+    for _ in range(5):
+        # Check up to 20 unleased pending documents at once, straight from memory when the listener is up
+        if pending_pool.is_live():
+            candidates = pending_pool.candidates(20)
+        else:
+            candidates = pending_candidates(db, nameofcollection, fields=review_item_fields)[:20]
+        if not candidates:
+            return None, None
+
+        # Before showing any of them, check which texts have already been
+        # approved/edited/rejected (possibly by someone else just now)
+        texts = {}
+        for doc in candidates:
+            data = doc.to_dict()
+            texts[doc.id] = data.get("text_key") or text_key(data["CodeSwitchedText"])
+        already_done = find_decided_duplicates(db, nameofcollection, "text_key", list(texts.values()))
+
+        # Update every candidate that has a completed twin, so the user never
+        # sees them. Each write only lands (and counts) if the document hasn't
+        # changed since it was read
+        clean = []
+        for doc in candidates:
+            existing_data = already_done.get(texts[doc.id])
+            if existing_data is None:
+                clean.append(doc)
+            else:
+                auto_sync_duplicate(db, nameofcollection, doc, existing_data)
+
+        # Serve the first truly unreviewed one we manage to claim
+        for doc in clean:
+            if claim_document(db, nameofcollection, doc, claimant):
+                return doc.id, doc.to_dict()
+
+    return None, None
+
+# Function to get a claimed item ready for display: tags and audio are resolved up front
+def prepare_review_item(doc_id, text_data):
+    text_data["CodeSwitchedText"] = text_data["CodeSwitchedText"].strip('"')
+    # Remember the key of the text as uploaded; edits change CodeSwitchedText but not the duplicate group
+    text_data.setdefault("text_key", text_key(text_data["CodeSwitchedText"]))
+    audio = text_data.get("Audio_link")
+    if isinstance(audio, str) and audio.startswith("http"):
+        try:
+            with urllib.request.urlopen(audio, timeout=10) as response:
+                audio = response.read()
+        except Exception as e:
+            # Leave the link in place, the browser can still try to fetch it itself
+            print(f"Could not prefetch audio for {doc_id}: {e}")
+    # Start from the tags computed at upload; tag here only for prompts uploaded before they were stored
+    words = text_data["CodeSwitchedText"].split()
+    stored_tags = text_data.get("auto_language_tags")
+    if stored_tags and len(stored_tags) == len(words):
+        word_tags = list(zip(words, stored_tags))
     else:
-        return None, None
+        word_tags = light_tagger(text_data["CodeSwitchedText"])
+    return {
+        "doc_id": doc_id,
+        "text_data": text_data,
+        "word_tags": word_tags,
+        "audio": audio
+    }
+
+# Function run on a background thread to top the session's buffer up to prefetch_depth items
+def fill_prefetch_buffer(buffer, claimant):
+    while buffer.qsize() < prefetch_depth:
+        doc_id, text_data = load_next_text(claimant)
+        if not text_data:
+            break
+        buffer.put(prepare_review_item(doc_id, text_data))
+
+# Function to start the background refill unless one is already running for this session
+def refill_prefetch_buffer():
+    worker = st.session_state.prefetch_worker
+    if worker is None or not worker.is_alive():
+        worker = threading.Thread(
+            target=fill_prefetch_buffer,
+            args=(st.session_state.prefetch_buffer, st.session_state.username),
+            daemon=True
+        )
+        worker.start()
+        st.session_state.prefetch_worker = worker
+
+# Function to get the next review item, served from the prefetch buffer when possible
+def next_review_item():
+    item = None
+    while item is None:
+        try:
+            item = st.session_state.prefetch_buffer.get_nowait()
+        except queue.Empty:
+            # Nothing ready yet (first load or the buffer ran dry), fetch one in the foreground
+            doc_id, text_data = load_next_text(st.session_state.username)
+            item = prepare_review_item(doc_id, text_data) if text_data else None
+            break
+        # The lease was taken when the item was buffered; restart it now that the reviewer sees it,
+        # and drop items that were reviewed or claimed by someone else while they sat in the buffer
+        if not renew_lease(db, nameofcollection, item["doc_id"], st.session_state.username):
+            item = None
+    refill_prefetch_buffer()
+    return item
+
+# Function to record a write in the local journal and apply it, now or on the write-behind queue
+def run_write(label, op, **payload):
+    entry_id = journal.record(op, payload, owner=st.session_state.username)
+    if st.session_state.write_behind:
+        write_queue.submit(st.session_state.username, label, apply_entry, journal, journal_handlers, entry_id, op, payload,
+                           ref=entry_id)
+        return None
+    try:
+        return apply_entry(journal, journal_handlers, entry_id, op, payload)
+    except Exception as e:
+        # Part of the write may have landed (e.g. some of a duplicate group), so finish this same
+        # write rather than have the reviewer submit a new one; replays re-read what already landed,
+        # and the journal's staleness checks keep them from overwriting newer decisions
+        write_queue.submit(st.session_state.username, label, apply_entry, journal, journal_handlers, entry_id, op, payload,
+                           ref=entry_id)
+        st.warning(f"{label} failed ({e}), retrying it in the background. Check the sidebar if it keeps failing.")
+        return None
 
 # Function to save the review decision
-def save_review(doc_id, review_data, original_text_content):
+def save_review(doc_id, review_data, original_text_key):
     """
     Updates the current document and all other pending documents 
-    that share the same original text.
+    that share the same original text (same text_key).
+    Returns the number of documents updated, or None when the write was queued.
     """
     review_data["Timestamp"] = datetime.utcnow()  # Add a timestamp
-    
-    # Initialize a batch
-    batch = db.batch()
-    count = 0
-    
-    # 1. Add the current document to the batch explicitly 
-    # (in case the query below misses it due to latency or specific filters)
-    current_doc_ref = db.collection(nameofcollection).document(doc_id)
-    batch.update(current_doc_ref, review_data)
-    count += 1
-
-    # 2. Query for ALL pending documents with the same CodeSwitchedText
-    duplicates = db.collection(nameofcollection)\
-        .where("CodeSwitchedText", "==", original_text_content)\
-        .where("Status", "==", "pending")\
-        .stream()
-
-    for doc in duplicates:
-        # Skip the current doc_id because we already added it above
-        if doc.id == doc_id:
-            continue
-            
-        doc_ref = db.collection(nameofcollection).document(doc.id)
-        batch.update(doc_ref, review_data)
-        count += 1
-
-        # Firestore batches allow max 500 operations. 
-        # If we hit 450, commit and restart batch to be safe.
-        if count >= 450:
-            batch.commit()
-            batch = db.batch()
-            count = 0
-
-    # Commit any remaining operations
-    if count > 0:
-        batch.commit()
-        
-    return count # Return count to show the user how much work they saved!
+    review_data["submission_id"] = uuid.uuid4().hex  # Tags every document this decision is written to, for undo
+    return run_write(f"Review of {doc_id}", "save_review",
+                     doc_id=doc_id, review_data=review_data, original_text_key=original_text_key)
+
+# Function to serve a read from this session's cache while it is younger than cache_ttl
+def cached_read(key, fetch, ttl=cache_ttl):
+    entry = st.session_state.read_cache.get(key)
+    if entry is None or time.time() - entry["fetched_at"] > ttl:
+        entry = {"value": fetch(), "fetched_at": time.time()}
+        st.session_state.read_cache[key] = entry
+    return entry["value"]
+
+# Function to apply this session's own write to a cached value, so it shows up without another query
+def apply_local_write(key, update):
+    entry = st.session_state.read_cache.get(key)
+    if entry is not None:
+        entry["value"] = update(entry["value"])
+
+# Function to drop cached reads whose key starts with one of the given names
+def invalidate_reads(*names):
+    for key in [key for key in st.session_state.read_cache if key[0] in names]:
+        del st.session_state.read_cache[key]
+    if "review_history" in names:
+        # The paged history lives outside the TTL cache, but this session's writes still make it stale
+        st.session_state.history_pages = None
 
 # Function to get the count of reviews done by the reviewer
 def get_review_count(username):
-    docs = db.collection(nameofcollection).where("reviewer", "==", username).stream()
-    return sum(1 for _ in docs)
-
-# Function to get the history of prompts reviewed by the user
-def get_review_history(username, limit):
-    docs = db.collection(nameofcollection).where("reviewer", "==", username).stream()
+    # Read from the reviewer's sharded counter, kept up to date by every review write
+    return read_counter(db, nameofcollection, "reviewer", username)
+
+# Function to get one page of the history of prompts reviewed by the user, newest first
+def get_review_history(username, limit, cursor=None):
+    query = db.collection(nameofcollection)\
+        .where("reviewer", "==", username)\
+        .where("pulled", "==", False)\
+        .order_by("Timestamp", direction=firestore.Query.DESCENDING)\
+        .select(history_fields)
+    if cursor is not None:
+        query = query.start_after(cursor)  # Continue after the last document of the previous page
+    docs = list(query.limit(limit).stream())
     history = []
     for doc in docs:
         data = doc.to_dict()
-        if not data.get("pulled", False) and data.get("Timestamp") is not None:  # Filter out documents where "pulled" is True or Timestamp is None
-            history.append({
-                "doc_id": doc.id,
-                "OriginalText": data.get("OriginalText"),
-                "CodeSwitchedText": data.get("CodeSwitchedText"),
-                "reviewed_text": data.get("reviewed_text"),
-                "Status": data.get("Status"),
-                "Timestamp": data.get("Timestamp"),
-                "language_tags":data.get("language_tags"),
-                "emotions": data.get("emotions"),
-                "domain": data.get("domain")
-            })
-    # Sort history by Timestamp in descending order and limit results
-    sorted_history = sorted(history, key=lambda x: x["Timestamp"], reverse=True)
-    return sorted_history[:limit]
+        history.append({
+            "doc_id": doc.id,
+            "OriginalText": data.get("OriginalText"),
+            "CodeSwitchedText": data.get("CodeSwitchedText"),
+            "reviewed_text": data.get("reviewed_text"),
+            "Status": data.get("Status"),
+            "Timestamp": data.get("Timestamp"),
+            "language_tags": document_tags(data),  # (word, language) tuples, from either storage format
+            "emotions": data.get("emotions"),
+            "domain": data.get("domain")
+        })
+    # The last document is the cursor for the next page; None once there is nothing left
+    next_cursor = docs[-1] if len(docs) == limit else None
+    return history, next_cursor
+
+# Function to start a paged history: the first page plus the cursor for "Load more"
+def first_history_page(username, page_size):
+    records, cursor = get_review_history(username, page_size)
+    # A freshly read record was reviewed again since any earlier undo of it
+    for record in records:
+        st.session_state.pop(f"undone_{record['doc_id']}", None)
+    return {"records": records, "cursor": cursor}
 
 # Function to update a specific review
 def update_review(doc_id, edited_text):
-    db.collection(nameofcollection).document(doc_id).update({
-        "reviewed_text": edited_text,
-        "Timestamp": datetime.utcnow(),
-        "Status": "edit"
-    })
+    run_write(f"Update of {doc_id}", "update_review", doc_id=doc_id, edited_text=edited_text, timestamp=datetime.utcnow())
+
+# Function to undo reviews, reverting every document their submissions wrote
+def undo_reviews(doc_ids):
+    return run_write(f"Undo of {len(doc_ids)} reviews", "undo_reviews", doc_ids=doc_ids, timestamp=datetime.utcnow())
 
 def undo_review(doc_id):
-    db.collection(nameofcollection).document(doc_id).update({
-        "Timestamp": datetime.utcnow(),
-        "Status": "pending",
-        "reviewer": None
-    })
+    return undo_reviews([doc_id])
 
-# Function to fetch review data for analytics
+# Function to fetch review data for analytics from the local mirror, after pulling in what changed since the last sync
 def fetch_review_data():
-    docs = db.collection(nameofcollection).stream()
-    data = []
-    for doc in docs:
-        record = doc.to_dict()
-        if not record["pulled"]:
-            data.append({
-                "reviewer": record.get("reviewer", "unreviewed"),
-                "Status": record["Status"]
-            })
-    data = pd.DataFrame(data)
-    data["reviewer"] = data["reviewer"].str.strip()
+    review_mirror.sync(db, nameofcollection)
+    data = pd.DataFrame(review_mirror.review_rows(), columns=["reviewer", "Status", "Timestamp"])
+    data["reviewer"] = data["reviewer"].fillna("unreviewed").str.strip()
+    data["Timestamp"] = pd.to_datetime(data["Timestamp"], utc=True)
+    return data
+
+# Function to fetch the materialized analytics summary: one document read instead of a collection scan
+def fetch_review_summary():
+    counts = read_summary(db, nameofcollection)
+    data = pd.DataFrame(
+        [{"reviewer": reviewer, "Status": status, "count": count}
+         for reviewer, statuses in counts.items()
+         for status, count in statuses.items()
+         if count > 0],
+        columns=["reviewer", "Status", "count"]
+    )
     return data
 
 def play_audio(file_path):
@@ -221,11 +355,14 @@ def display_buttons(word_tags, num_cols):
         # Create the button in the corresponding column
         col = cols[i % num_cols]  # Cycle through columns for each word
         with col:
-            button = st.button(button_text, key=button_key)
+            # When the button is clicked, toggle the word's tag (between 'en' and 'yo')
+            st.button(button_text, key=button_key, on_click=toggle_tag, args=(i,))
 
-            # When the button is clicked, toggle the word's tag
-            if button:
-                toggle_tag(i)  # This function will toggle between 'en' and 'yo'
+# The sentence and its word buttons as a fragment: a toggle only reruns this part of the page
+@st.fragment
+def word_tag_grid(num_cols):
+    st.markdown(f"<h3>{display_colored_sentence(st.session_state.word_tags)}</h3>", unsafe_allow_html=True)
+    display_buttons(st.session_state.word_tags, num_cols)
 
 # Function to toggle language tag when a word is clicked
 def toggle_tag(word_index):
@@ -237,7 +374,7 @@ def toggle_tag(word_index):
     
     # Update the word tag in session state
     st.session_state.word_tags[word_index] = (current_word, new_tag)
-    st.rerun()
+    # No st.rerun() needed: as a button callback this runs before the fragment redraws
     # st.write(f"Tag for '{current_word}' changed to {new_tag}")  # Optional: Show immediate feedback
 
 # Function to update the reflected text when the text area changes
@@ -245,6 +382,84 @@ def update_reflection():
     st.session_state.text_data["CodeSwitchedText"] = st.session_state.edited_text
     st.session_state.word_tags = None
 
+# Sidebar stats as a fragment, refreshed on their own every few seconds without rerunning the page
+@st.fragment(run_every=5)
+def sidebar_stats(show_review_count):
+    if show_review_count:
+        # Get the review count for the current reviewer
+        review_count = cached_read(("review_count", st.session_state.username),
+                                   lambda: get_review_count(st.session_state.username))
+        st.write(f"Reviews Completed: {review_count}")
+
+    # Show writes that are still on their way to Firestore, and any that gave up
+    pending_writes = write_queue.pending_count(st.session_state.username)
+    if pending_writes:
+        st.write(f"Pending writes: {pending_writes}")
+    for failure in write_queue.failures(st.session_state.username):
+        st.error(f"{failure['label']} failed: {failure['error']}")
+        retry_col, dismiss_col = st.columns(2)
+        if retry_col.button("Retry", key=f"retry_{failure['id']}"):
+            write_queue.retry(failure["id"])
+            st.rerun(scope="fragment")
+        if dismiss_col.button("Dismiss", key=f"dismiss_{failure['id']}"):
+            write_queue.dismiss(failure["id"])
+            # Dismissed for good: keep the journal from replaying it at the next start
+            if failure["ref"] is not None:
+                journal.mark_abandoned(failure["ref"])
+            st.rerun(scope="fragment")
+
+# A history record as a fragment: undoing it only reruns this record, not the whole page
+@st.fragment
+def history_record(record):
+    if st.session_state.get(f"undone_{record['doc_id']}"):
+        st.write("---")
+        st.write(f"**Original Text:** {record['OriginalText']}")
+        st.success("Review undone successfully it'll go back to main page!")
+        return
+
+    st.write("---")
+    st.write(f"**Original Text:** {record['OriginalText']}")
+    st.write(f"**Code-Switched Text:** {record['CodeSwitchedText']}")
+    st.write(f"**Your Reviewed Text:** {record['reviewed_text']}")
+    # st.write(str(record['language_tags']))
+    st.markdown(f"**Your Reviewed Text (Blue:Eng):** {display_colored_sentence(record['language_tags'])}", unsafe_allow_html=True)
+    st.write(f"**Emotions:** {record['emotions']}")
+    st.write(f"**Status:** {record['Status']}")
+    st.write(f"**Timestamp:** {record['Timestamp']}")
+    st.write(f"**Domain:** {record['domain']}")
+    st.checkbox("Select for bulk undo", key=f"select_{record['doc_id']}")
+
+    # # Option to edit the record
+    # if st.button(f"Edit Review - {record['doc_id']}"):
+    #     # Set a flag in session state to indicate which record is being edited
+    #     st.session_state.editing_record = record['doc_id']
+    #     st.session_state.new_text = record['reviewed_text']
+
+    # Check if this record is being edited
+    # if st.session_state.get('editing_record') == record['doc_id']:
+    #     # Text area for editing the text
+    #     st.session_state.new_text = st.text_area(
+    #         "Edit the Code-Switched Text:", 
+    #         st.session_state.new_text, 
+    #         key=f"text_area_{record['doc_id']}"
+    #     )
+        
+    #     # Button to save changes
+    # if st.button(f"Save Changes - {record['doc_id']}"):
+    #         # Perform the update
+    #         update_review(record['doc_id'], st.session_state.new_text)
+    #         st.success("Review updated successfully!")
+    #         # Clear the editing state
+    #         del st.session_state.editing_record
+    #         st.rerun()
+    # Button to undo the review
+    if st.button(f"Undo Review - {record['doc_id']}"):
+        # Perform the update (queued behind this reviewer's pending writes in write-behind mode)
+        undo_review(record['doc_id'])
+        invalidate_reads("review_count", "review_history", "review_summary")
+        st.session_state[f"undone_{record['doc_id']}"] = True
+        st.rerun(scope="fragment")
+
 # Streamlit App Layout
 if "username" not in st.session_state:
     st.session_state.username = None
@@ -272,9 +487,30 @@ if "text_data" not in st.session_state:
 if "doc_id" not in st.session_state:
     st.session_state.doc_id = None
 
+if "audio" not in st.session_state:
+    st.session_state.audio = None
+
+if "prefetch_buffer" not in st.session_state:
+    st.session_state.prefetch_buffer = queue.Queue()
+if "prefetch_worker" not in st.session_state:
+    st.session_state.prefetch_worker = None
+
+if "read_cache" not in st.session_state:
+    st.session_state.read_cache = {}
+
+# History pages loaded so far and the cursor for "Load more"; kept until this session writes or the page size changes
+if "history_pages" not in st.session_state:
+    st.session_state.history_pages = None
+
+if "write_behind" not in st.session_state:
+    st.session_state.write_behind = False
+
 if "max_num_cols" not in st.session_state:
     st.session_state.max_num_cols = 2
 
+if "browser_tagging" not in st.session_state:
+    st.session_state.browser_tagging = True
+
 
 if st.session_state.username is None:
     # Prompt user to enter their name
@@ -302,18 +538,29 @@ else:
 
     # Navigation Menu
     page = st.sidebar.radio("Navigate", ["Review", "History", "Analytics", "Upload Prompts"])
-    st.session_state.max_num_cols = st.sidebar.slider(
-        "Select the number of columns for word buttons",
-        min_value=1,
-        max_value=10,  # You can adjust the max value based on your needs
-        value=7,  # Default value
-        step=1
+    st.session_state.browser_tagging = st.sidebar.toggle(
+        "Tag words in the browser",
+        value=st.session_state.browser_tagging,
+        help="Click words in the sentence to switch their language without waiting for the server. Turn off to use the word buttons."
+    )
+    if not st.session_state.browser_tagging:
+        st.session_state.max_num_cols = st.sidebar.slider(
+            "Select the number of columns for word buttons",
+            min_value=1,
+            max_value=10,  # You can adjust the max value based on your needs
+            value=7,  # Default value
+            step=1
+        )
+    st.session_state.write_behind = st.sidebar.toggle(
+        "Save in the background",
+        value=st.session_state.write_behind,
+        help="Move on to the next prompt straight away while your review is written to the database."
     )
 
+    with st.sidebar:
+        sidebar_stats(page == "Review")
+
     if page == "Review":
-        # Get the review count for the current reviewer
-        review_count = get_review_count(st.session_state.username)
-        st.sidebar.write(f"Reviews Completed: {review_count}")
 
         st.markdown("### Review Process:")
         with st.expander("Review and Emotion Selection Instructions"):
@@ -325,7 +572,7 @@ else:
 
                     - **Language Tagging**: As you review the text, you can click on the **buttons next to each word** to change its language tag. Words tagged as **English (blue)** can be switched to **Yoruba (red)**, and vice versa. This helps ensure the language tags are accurate for each word based on its language. You can toggle the tag between **English** and **Yoruba** by clicking the buttons. 
 
-                    - **Undo a Mistake**: If you submit a review by mistake, don't worry! You can go to the **History tab** to view your past reviews. If you need to, you can undo any review by clicking the **Undo Review** button for that specific entry. This will reset the review back to its initial "pending" state, allowing you to make corrections.
+                    - **Undo a Mistake**: If you submit a review by mistake, don't worry! You can go to the **History tab** to view your past reviews. If you need to, you can undo any review by clicking the **Undo Review** button for that specific entry. This will reset the review (and every duplicate it was applied to) back to its initial "pending" state, allowing you to make corrections. To undo several at once, tick **Select for bulk undo** on each and press the undo button below the list.
 
                     - **Contact Victor for Help**: If you're unsure about anything or need assistance, please **contact Victor**. Don't hesitate to ask for help to ensure you're reviewing correctly and following the right steps.
 
@@ -335,13 +582,16 @@ else:
                     """)
 
 
-        # Load the next unreviewed text
-        doc_id, text_data = load_next_text()
+        # Claim the next unreviewed text, unless this session is still working on one
+        if st.session_state.text_data== None:
+            item = next_review_item()
+            if item:
+                st.session_state.text_data = item["text_data"]
+                st.session_state.doc_id = item["doc_id"]
+                st.session_state.word_tags = item["word_tags"]
+                st.session_state.audio = item["audio"]
 
-        if text_data:
-            if st.session_state.text_data== None:
-                st.session_state.text_data = text_data
-                st.session_state.doc_id = doc_id
+        if st.session_state.text_data:
             corrected_tags = []
             # Display the Original Text, Code-Switched Text, and Creator's Name
             # st.title("Text Review")
@@ -374,10 +624,12 @@ else:
             with colB:
                 st.markdown("<p style='color:red;'>Red = Yorùbá</p>", unsafe_allow_html=True)
 
-            st.markdown(f"<h3>{display_colored_sentence(st.session_state.word_tags)}</h3>", unsafe_allow_html=True)
-
-            # Call the function to display the buttons
-            display_buttons(st.session_state.word_tags,st.session_state.max_num_cols)
+            if st.session_state.browser_tagging:
+                # Read-only here; the clickable copy with Submit Review comes after the review actions
+                st.markdown(f"<h3>{display_colored_sentence(st.session_state.word_tags)}</h3>", unsafe_allow_html=True)
+            else:
+                # Call the function to display the sentence and the buttons
+                word_tag_grid(st.session_state.max_num_cols)
 
             # with st.expander("More details"):
             #     (st.write(dict(st.session_state.word_tags)))
@@ -387,8 +639,7 @@ else:
             st.write("### Review Actions")
             action = st.radio("Choose Action", [ "Edit", "Approve","Reject" ])# [ "Edit", "Approve", "Reject"]
             with st.expander("Listen to the audio prompt", expanded=True):
-                file_path = st.session_state.text_data["Audio_link"]
-                st.audio(file_path, format="audio/mp3", autoplay=True)
+                st.audio(st.session_state.audio, format="audio/mp3", autoplay=True)
            
             # Emotion single-select dropdown
             selected_emotions = st.selectbox(
@@ -414,27 +665,54 @@ else:
             #     corrected_lang = st.selectbox(f"Correct the language tag for '{word}'", ["en", "yo"], index=["en", "yo"].index(lang))
             #     corrected_tags.append((word, corrected_lang))
 
-            if st.button("Submit Review"):
+            if st.session_state.browser_tagging:
+                # Rendered after the review actions, so its Submit Review button is the last step like the page's own.
+                # Words are toggled in the browser; the tags come back once, when the reviewer submits
+                st.write("#### Language Tags")
+                st.caption("Click a word to switch its language, then press Submit Review.")
+                submitted_tags = word_tagger(st.session_state.word_tags, key=f"word_tagger_{st.session_state.doc_id}")
+                submitted = submitted_tags is not None
+                if submitted:
+                    st.session_state.word_tags = submitted_tags
+            else:
+                submitted = st.button("Submit Review")
+
+            if submitted:
+                # Logic: If edited, save the edited text. If approved, save the original.
+                reviewed_text = edited_text if action == "Edit" else st.session_state.text_data["CodeSwitchedText"]
                 review_data = {
                     "Status": action.lower(),
                     "reviewer": st.session_state.username,
-                    # Logic: If edited, save the edited text. If approved, save the original.
-                    "reviewed_text": edited_text if action == "Edit" else st.session_state.text_data["CodeSwitchedText"],
+                    "reviewed_text": reviewed_text,
                     "emotions": selected_emotions,
-                    "language_tags": tag(st.session_state.word_tags),
+                    # Run-length encoded over the words of reviewed_text, e.g. "en:3 yo:2"
+                    **language_tag_fields(reviewed_text, st.session_state.word_tags),
                     "domain": selected_domain.title()
                 }
                 
-                # Get the ORIGINAL text (before edit) to find duplicates
-                original_content_for_query = st.session_state.text_data["CodeSwitchedText"]
+                # Get the key of the ORIGINAL text (before edit) to find duplicates
+                original_key_for_query = st.session_state.text_data["text_key"]
                 
-                with st.spinner("Applying review to all duplicates..."):
-                    # Pass the original text to the new function
-                    updated_count = save_review(st.session_state.doc_id, review_data, original_content_for_query)
-
-                # Confirmation
-                st.success(f"Review submitted! You automatically updated {updated_count} duplicate entries.")
-                time.sleep(2) # Give them a second to read the success message
+                if st.session_state.write_behind:
+                    # The write is journaled and handed to the background worker, move straight on
+                    save_review(st.session_state.doc_id, review_data, original_key_for_query)
+                    st.toast("Review queued!")
+                    updated_count = 1  # Duplicates are only known once the write lands; the next refresh catches up
+                else:
+                    with st.spinner("Applying review to all duplicates..."):
+                        # Pass the original text key to the new function
+                        updated_count = save_review(st.session_state.doc_id, review_data, original_key_for_query)
+
+                    if updated_count is None:
+                        updated_count = 1  # Handed to the background retry; the next refresh catches up
+                    else:
+                        # Confirmation
+                        st.success(f"Review submitted! You automatically updated {updated_count} duplicate entries.")
+                    time.sleep(2) # Give them a second to read the message
+
+                # Reflect the review in the cached sidebar count, and refetch history next time it is viewed
+                apply_local_write(("review_count", st.session_state.username), lambda count: count + updated_count)
+                invalidate_reads("review_history", "review_summary")
                 
                 st.session_state.word_tags=None
                 st.session_state.text_data = None
@@ -445,55 +723,40 @@ else:
     elif page == "History":
         st.title("Review History")
 
-        # User specifies the number of records to retrieve
-        num_records = st.number_input("Number of records to retrieve:", min_value=1, max_value=100, value=10)
+        # User specifies how many records each page loads
+        page_size = st.number_input("Records per page:", min_value=1, max_value=100, value=10)
 
-        # Fetch and display the review history
-        history = get_review_history(st.session_state.username, num_records)
+        # Fetch and display the review history, keeping the pages loaded so far
+        history_key = (st.session_state.username, page_size)
+        if st.session_state.history_pages is None or st.session_state.history_pages["key"] != history_key:
+            st.session_state.history_pages = {"key": history_key, **first_history_page(st.session_state.username, page_size)}
+        history_pages = st.session_state.history_pages
+        history = history_pages["records"]
 
         if history:
             for record in history:
-                st.write("---")
-                st.write(f"**Original Text:** {record['OriginalText']}")
-                st.write(f"**Code-Switched Text:** {record['CodeSwitchedText']}")
-                st.write(f"**Your Reviewed Text:** {record['reviewed_text']}")
-                # st.write(str(record['language_tags']))
-                st.markdown(f"**Your Reviewed Text (Blue:Eng):** {display_colored_sentence(reverse_tag(record['language_tags']))}", unsafe_allow_html=True)
-                st.write(f"**Emotions:** {record['emotions']}")
-                st.write(f"**Status:** {record['Status']}")
-                st.write(f"**Timestamp:** {record['Timestamp']}")
-                st.write(f"**Domain:** {record['domain']}")
-
-                # # Option to edit the record
-                # if st.button(f"Edit Review - {record['doc_id']}"):
-                #     # Set a flag in session state to indicate which record is being edited
-                #     st.session_state.editing_record = record['doc_id']
-                #     st.session_state.new_text = record['reviewed_text']
-
-                # Check if this record is being edited
-                # if st.session_state.get('editing_record') == record['doc_id']:
-                #     # Text area for editing the text
-                #     st.session_state.new_text = st.text_area(
-                #         "Edit the Code-Switched Text:", 
-                #         st.session_state.new_text, 
-                #         key=f"text_area_{record['doc_id']}"
-                #     )
-                    
-                #     # Button to save changes
-                # if st.button(f"Save Changes - {record['doc_id']}"):
-                #         # Perform the update
-                #         update_review(record['doc_id'], st.session_state.new_text)
-                #         st.success("Review updated successfully!")
-                #         # Clear the editing state
-                #         del st.session_state.editing_record
-                #         st.rerun()
-                                    # Button to save changes
-                if st.button(f"Undo Review - {record['doc_id']}"):
-                        # Perform the update
-                        undo_review(record['doc_id'])
-                        st.success("Review undone successfully it'll go back to main page!")
-                        # Clear the editing state
-                        st.rerun()
+                history_record(record)
+
+            # Undo every selected review (and the duplicates each one was applied to) in one write
+            if st.button("Undo selected reviews"):
+                selected_ids = [record["doc_id"] for record in history
+                                if st.session_state.get(f"select_{record['doc_id']}")
+                                and not st.session_state.get(f"undone_{record['doc_id']}")]
+                if selected_ids:
+                    undo_reviews(selected_ids)
+                    for doc_id in selected_ids:
+                        del st.session_state[f"select_{doc_id}"]
+                    invalidate_reads("review_count", "review_history", "review_summary")
+                    st.success("Selected reviews undone, they'll go back to the main page!")
+                    st.rerun()
+                else:
+                    st.warning("No reviews selected.")
+
+            if history_pages["cursor"] is not None and st.button("Load more"):
+                records, cursor = get_review_history(st.session_state.username, page_size, history_pages["cursor"])
+                history_pages["records"].extend(records)
+                history_pages["cursor"] = cursor
+                st.rerun()
 
         else:
             st.write("No history available.")
@@ -501,13 +764,12 @@ else:
     elif page == "Analytics":
         st.title("Reviewer Analytics")
 
-        # Fetch review data and compute analytics
-        review_data = fetch_review_data()
+        # Fetch the review summary (documents per reviewer and status) and compute analytics
+        review_data = cached_read(("review_summary",), fetch_review_summary)
         if not review_data.empty:
-            review_data =  review_data.fillna("unreviewed")
             original_review_data = review_data.copy()
             review_data = review_data[(review_data["reviewer"] != "unreviewed") & (review_data["Status"] != "reject")]
-            status_count = review_data.groupby(['reviewer', 'Status']).size().unstack(fill_value=0)
+            status_count = review_data.pivot_table(index="reviewer", columns="Status", values="count", aggfunc="sum", fill_value=0)
             try:
                 status_count["sum"] =  status_count["edit"]
             except:
@@ -538,12 +800,27 @@ else:
             st.write("Breakdown: Note that I've excluded your rejections, and this is data that has not been uploaded to the speech app")
             st.write(f"Right now, {status_count.index[-1].title()} is on 🔥🔥")
 
-            st.write(review_data["reviewer"].value_counts())
+            reviewer_totals = review_data.groupby("reviewer")["count"].sum().sort_values(ascending=False)
+            st.write(reviewer_totals)
             # st.write(original_review_data)
             unreviewed_df = original_review_data[(original_review_data["reviewer"]=="unreviewed") & (original_review_data["Status"] != "reject")]
             # st.write(unreviewed_df)
-            st.write("Sum total is: ", str(review_data["reviewer"].value_counts().sum()), "prompts")
-            st.write("Unreviwed Prompts: ", str(len(unreviewed_df)), "prompts")
+            st.write("Sum total is: ", str(reviewer_totals.sum()), "prompts")
+            st.write("Unreviwed Prompts: ", str(unreviewed_df["count"].sum()), "prompts")
+
+            # Daily activity, from the local mirror (only changes since the last visit are fetched)
+            with st.expander("Daily review activity (last 30 days)"):
+                mirror_data = cached_read(("review_data",), fetch_review_data)
+                recent = mirror_data[
+                    (mirror_data["reviewer"] != "unreviewed")
+                    & (mirror_data["Status"].isin(["approve", "edit"]))
+                    & (mirror_data["Timestamp"] >= pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=30))
+                ]
+                if recent.empty:
+                    st.write("No reviews in the last 30 days.")
+                else:
+                    daily = recent.groupby([recent["Timestamp"].dt.date, "reviewer"]).size().unstack(fill_value=0)
+                    st.bar_chart(daily)
 
 
         else:
@@ -611,24 +888,49 @@ else:
                     st.session_state.upload_started = True
                     with st.spinner("Uploading data to Firestore..."):
                         progress_bar = st.progress(0)  # Initialize the progress bar
-                        total_rows = len(st.session_state.dataframe)  # Total number of rows to upload
-
-                        for index, row in enumerate(st.session_state.dataframe.iterrows(), start=1):
-                            _, data_row = row
-                            doc_id = data_row["ID"]
-                            data = {
-                                "OriginalText": data_row["Original Text"],
-                                "CodeSwitchedText": data_row["code-switched-text"],
-                                "CreatorName": data_row["Creator's Name"],
-                                "Status": data_row["Status"],
-                                "domain": data_row["domain"],
-                                "pulled": data_row["pulled"]
-                            }
-                            db.collection(nameofcollection).document(doc_id).set(data)
+
+                        # Collapse duplicate prompts into one canonical document per text_key
+                        df = st.session_state.dataframe.copy()
+                        df["text_key"] = df["code-switched-text"].map(text_key)
+                        groups = df.groupby("text_key", sort=False)
+                        total_groups = len(groups)  # Total number of canonical documents to write
+                        existing = find_by_text_keys(db, nameofcollection, list(groups.groups))
+                        # Tag every distinct prompt in one pass, so the Review page doesn't have to
+                        canonical = df.drop_duplicates("text_key")
+                        auto_tags = dict(zip(canonical["text_key"], light_tagger_batch(canonical["code-switched-text"].astype(str))))
+                        created_docs = []
+
+                        for index, (key, group) in enumerate(groups, start=1):
+                            member_ids = list(group["ID"])
+                            if key in existing:
+                                # The prompt is already in the stage: add the new copies to its group
+                                snapshot = existing[key]
+                                current_members = snapshot.to_dict().get("member_ids") or [snapshot.id]
+                                new_members = [member_id for member_id in member_ids if member_id not in current_members]
+                                if new_members:
+                                    old_data = snapshot.to_dict()
+                                    group_update = {
+                                        "member_ids": current_members + new_members,
+                                        "multiplicity": len(current_members) + len(new_members)
+                                    }
+                                    batch = db.batch()
+                                    batch.update(snapshot.reference, group_update)
+                                    # The new copies are prompts too, in the counters and the Analytics summary
+                                    add_review_stats(batch, db, nameofcollection, [old_data], [{**old_data, **group_update}])
+                                    batch.commit()
+                            else:
+                                data_row = group.iloc[0]
+                                created_docs.append((data_row["ID"], prompt_document(data_row, member_ids, auto_tags[key])))
+                                if len(created_docs) >= 400:
+                                    # Each batch counts its own documents, so an interrupted upload still matches the counters
+                                    create_documents(db, nameofcollection, created_docs)
+                                    created_docs = []
 
                             # Update progress bar
-                            progress = int((index / total_rows) * 100)
+                            progress = int((index / total_groups) * 100)
                             progress_bar.progress(progress)
 
-                    st.success("All data uploaded successfully!")
+                        create_documents(db, nameofcollection, created_docs)
+
+                    st.success(f"All data uploaded successfully! {len(df)} prompts were stored as {total_groups} review items.")
                     st.session_state.upload_started = False  # Reset the upload state
\ No newline at end of file
@@ -2,6 +2,7 @@ import streamlit as st
 from firebase_admin import credentials, firestore, initialize_app, _apps
 import json
 import os
+from firestore_utils import claim_next_pending, LEASE_RELEASE
 
 # Initialize Firebase if it hasn't been initialized yet
 firebase_secrets = json.loads(os.environ['firebase_credentials'])
@@ -12,21 +13,22 @@ if not _apps:
 
 db = firestore.client()
 
-# Function to load the next text to review
-def load_next_text():
-    docs = db.collection("texts").where("Status", "==", "pending").limit(1).stream()
-    for doc in docs:
+# Function to claim the next text to review
+def load_next_text(claimant):
+    doc = claim_next_pending(db, "texts", claimant, fields=["Text", "CodeSwitchedText", "Status"])
+    if doc:
         return doc.id, doc.to_dict()
     return None, None
 
 # Function to save the review
 def save_review(doc_id, review_data):
-    db.collection("texts").document(doc_id).update(review_data)
+    db.collection("texts").document(doc_id).update({**review_data, **LEASE_RELEASE})
 
 # Function to get the count of completed reviews by the user (excluding rejects)
 def get_review_count(username):
-    docs = db.collection("texts").where("reviewer", "==", username).where("Status", "in", ["approve", "edit"]).stream()
-    return sum(1 for _ in docs)
+    # Counted server-side: one aggregation read instead of reading every document
+    result = db.collection("texts").where("reviewer", "==", username).where("Status", "in", ["approve", "edit"]).count().get()
+    return result[0][0].value
 
 # Check if username is in session_state, if not, prompt for it
 if "username" not in st.session_state:
@@ -68,7 +70,10 @@ else:
     # Main app layout for reviewing
     st.title("Code-Switched Text Reviewer")
 
-    doc_id, text_data = load_next_text()
+    # Keep the claimed text across reruns so widget changes don't claim a new one
+    if st.session_state.get("text_data") is None:
+        st.session_state.doc_id, st.session_state.text_data = load_next_text(st.session_state.username)
+    doc_id, text_data = st.session_state.doc_id, st.session_state.text_data
     if text_data:
         # Display the Yoruba text and AI code-switched text with increased font size and bold style
         st.markdown("## **Original Yoruba Text**")
@@ -98,6 +103,7 @@ else:
                 "reviewed_text": edited_text if action == "Edit" else text_data["CodeSwitchedText"] if action == "Approve" else None,
             }
             save_review(doc_id, review_data)
+            st.session_state.text_data = None
             
             st.success("Review submitted!")
             st.rerun()  # Reload to get the next text
@@ -7,8 +7,10 @@ from datetime import datetime
 import pandas as pd
 import matplotlib.pyplot as plt
 import time
-from utils import light_tagger, tag, reverse_tag
+from utils import light_tagger, light_tagger_batch, language_tag_fields, document_tags, text_key, prompt_document
 import random
+import uuid
+from firestore_utils import apply_review, apply_update, apply_undo, auto_sync_duplicate, create_documents, pending_candidates, claim_document
 
 
 # dotenv.load_dotenv()
@@ -28,12 +30,10 @@ if not _apps:
 db = firestore.client()
 
 # Function to load the next review item from a batch of 20 random documents
-def load_next_text():
-    # Fetch a batch of 20 documents where Status is "pending"
-    docs = db.collection(nameofcollection).where("Status", "==", "pending").limit(20).stream()
-
-    # Convert Firestore documents to a list
-    doc_list = [doc for doc in docs]
+def load_next_text(claimant):
+    # Fetch a batch of 20 documents where Status is "pending", leaving out those
+    # another session (of this app or the main one) is holding
+    doc_list = pending_candidates(db, nameofcollection, limit=20)
 
     # If there are any documents available
     if doc_list:
@@ -41,76 +41,44 @@ def load_next_text():
         random_doc = random.choice(doc_list)
         doc_id = random_doc.id
         doc_data = random_doc.to_dict()
+        # Documents uploaded before text_key existed get it computed here
+        doc_data["text_key"] = doc_data.get("text_key") or text_key(doc_data["CodeSwitchedText"])
 
         # --- NEW CHECK START ---
         # Before showing this, check if ANY document with this EXACT text 
         # has already been approved/edited (by someone else just now)
         already_done = db.collection(nameofcollection)\
-            .where("CodeSwitchedText", "==", doc_data["CodeSwitchedText"].strip())\
+            .where("text_key", "==", doc_data["text_key"])\
             .where("Status", "in", ["approve", "edit", "reject"])\
             .limit(1).get()
             
         if already_done:
             # If we found a completed version, update THIS current doc automatically
             # and skip to the next random one so the user doesn't see it.
-            existing_data = already_done[0].to_dict()
-            db.collection(nameofcollection).document(doc_id).update({
-                "Status": existing_data["Status"],
-                "reviewed_text": existing_data["reviewed_text"],
-                "reviewer": "System-AutoSync",
-                "Timestamp": datetime.utcnow()
-            })
-            return load_next_text() # Recursively look for a truly unreviewed one
+            # Only lands (and counts) if nobody changed the document since we read it
+            auto_sync_duplicate(db, nameofcollection, random_doc, already_done[0].to_dict())
+            return load_next_text(claimant) # Recursively look for a truly unreviewed one
         # --- NEW CHECK END ---
 
+        # Hold it while the reviewer works on it, so no other session is served it too
+        if not claim_document(db, nameofcollection, random_doc, claimant):
+            return load_next_text(claimant) # Someone else claimed it first
+
         return doc_id, doc_data
     else:
         return None, None
 
 # Function to save the review decision
-def save_review(doc_id, review_data, original_text_content):
+def save_review(doc_id, review_data, original_text_key):
     """
     Updates the current document and all other pending documents 
-    that share the same original text.
+    that share the same original text (same text_key).
     """
     review_data["Timestamp"] = datetime.utcnow()  # Add a timestamp
-    
-    # Initialize a batch
-    batch = db.batch()
-    count = 0
-    
-    # 1. Add the current document to the batch explicitly 
-    # (in case the query below misses it due to latency or specific filters)
-    current_doc_ref = db.collection(nameofcollection).document(doc_id)
-    batch.update(current_doc_ref, review_data)
-    count += 1
-
-    # 2. Query for ALL pending documents with the same CodeSwitchedText
-    duplicates = db.collection(nameofcollection)\
-        .where("CodeSwitchedText", "==", original_text_content)\
-        .where("Status", "==", "pending")\
-        .stream()
-
-    for doc in duplicates:
-        # Skip the current doc_id because we already added it above
-        if doc.id == doc_id:
-            continue
-            
-        doc_ref = db.collection(nameofcollection).document(doc.id)
-        batch.update(doc_ref, review_data)
-        count += 1
-
-        # Firestore batches allow max 500 operations. 
-        # If we hit 450, commit and restart batch to be safe.
-        if count >= 450:
-            batch.commit()
-            batch = db.batch()
-            count = 0
-
-    # Commit any remaining operations
-    if count > 0:
-        batch.commit()
-        
+    review_data["submission_id"] = uuid.uuid4().hex  # Lets an undo revert every copy this review wrote
+
+    # Writes the decision together with the review counters and Analytics summary
+    count = apply_review(db, nameofcollection, doc_id, review_data, original_text_key)
     return count # Return count to show the user how much work they saved!
 
 # Function to get the count of reviews done by the reviewer
@@ -132,7 +100,7 @@ def get_review_history(username, limit):
                 "reviewed_text": data.get("reviewed_text"),
                 "Status": data.get("Status"),
                 "Timestamp": data.get("Timestamp"),
-                "language_tags":data.get("language_tags"),
+                "language_tags": document_tags(data),  # (word, language) tuples, from either storage format
                 "emotions": data.get("emotions"),
                 "domain": data.get("domain")
             })
@@ -142,18 +110,10 @@ def get_review_history(username, limit):
 
 # Function to update a specific review
 def update_review(doc_id, edited_text):
-    db.collection(nameofcollection).document(doc_id).update({
-        "reviewed_text": edited_text,
-        "Timestamp": datetime.utcnow(),
-        "Status": "edit"
-    })
+    apply_update(db, nameofcollection, doc_id, edited_text, datetime.utcnow())
 
 def undo_review(doc_id):
-    db.collection(nameofcollection).document(doc_id).update({
-        "Timestamp": datetime.utcnow(),
-        "Status": "pending",
-        "reviewer": None
-    })
+    apply_undo(db, nameofcollection, doc_id, datetime.utcnow())
 
 # Function to fetch review data for analytics
 def fetch_review_data():
@@ -335,13 +295,14 @@ else:
                     """)
 
 
-        # Load the next unreviewed text
-        doc_id, text_data = load_next_text()
-
-        if text_data:
-            if st.session_state.text_data== None:
+        # Load the next unreviewed text, unless this session is still working on (and holding) one
+        if st.session_state.text_data== None:
+            doc_id, text_data = load_next_text(st.session_state.username)
+            if text_data:
                 st.session_state.text_data = text_data
                 st.session_state.doc_id = doc_id
+
+        if st.session_state.text_data:
             corrected_tags = []
             # Display the Original Text, Code-Switched Text, and Creator's Name
             # st.title("Text Review")
@@ -415,22 +376,24 @@ else:
             #     corrected_tags.append((word, corrected_lang))
 
             if st.button("Submit Review"):
+                # Logic: If edited, save the edited text. If approved, save the original.
+                reviewed_text = edited_text if action == "Edit" else st.session_state.text_data["CodeSwitchedText"]
                 review_data = {
                     "Status": action.lower(),
                     "reviewer": st.session_state.username,
-                    # Logic: If edited, save the edited text. If approved, save the original.
-                    "reviewed_text": edited_text if action == "Edit" else st.session_state.text_data["CodeSwitchedText"],
+                    "reviewed_text": reviewed_text,
                     "emotions": selected_emotions,
-                    "language_tags": tag(st.session_state.word_tags),
+                    # Run-length encoded over the words of reviewed_text, e.g. "en:3 yo:2"
+                    **language_tag_fields(reviewed_text, st.session_state.word_tags),
                     "domain": selected_domain.title()
                 }
                 
-                # Get the ORIGINAL text (before edit) to find duplicates
-                original_content_for_query = st.session_state.text_data["CodeSwitchedText"]
+                # Get the key of the ORIGINAL text (before edit) to find duplicates
+                original_key_for_query = st.session_state.text_data["text_key"]
                 
                 with st.spinner("Applying review to all duplicates..."):
-                    # Pass the original text to the new function
-                    updated_count = save_review(st.session_state.doc_id, review_data, original_content_for_query)
+                    # Pass the original text key to the new function
+                    updated_count = save_review(st.session_state.doc_id, review_data, original_key_for_query)
 
                 # Confirmation
                 st.success(f"Review submitted! You automatically updated {updated_count} duplicate entries.")
@@ -458,7 +421,7 @@ else:
                 st.write(f"**Code-Switched Text:** {record['CodeSwitchedText']}")
                 st.write(f"**Your Reviewed Text:** {record['reviewed_text']}")
                 # st.write(str(record['language_tags']))
-                st.markdown(f"**Your Reviewed Text (Blue:Eng):** {display_colored_sentence(reverse_tag(record['language_tags']))}", unsafe_allow_html=True)
+                st.markdown(f"**Your Reviewed Text (Blue:Eng):** {display_colored_sentence(record['language_tags'])}", unsafe_allow_html=True)
                 st.write(f"**Emotions:** {record['emotions']}")
                 st.write(f"**Status:** {record['Status']}")
                 st.write(f"**Timestamp:** {record['Timestamp']}")
@@ -612,23 +575,25 @@ else:
                     with st.spinner("Uploading data to Firestore..."):
                         progress_bar = st.progress(0)  # Initialize the progress bar
                         total_rows = len(st.session_state.dataframe)  # Total number of rows to upload
+                        # Tag every prompt in one pass, so the Review page doesn't have to
+                        auto_tags = light_tagger_batch(st.session_state.dataframe["code-switched-text"].astype(str))
+                        new_docs = []
 
                         for index, row in enumerate(st.session_state.dataframe.iterrows(), start=1):
                             _, data_row = row
                             doc_id = data_row["ID"]
-                            data = {
-                                "OriginalText": data_row["Original Text"],
-                                "CodeSwitchedText": data_row["code-switched-text"],
-                                "CreatorName": data_row["Creator's Name"],
-                                "Status": data_row["Status"],
-                                "domain": data_row["domain"],
-                                "pulled": data_row["pulled"]
-                            }
-                            db.collection(nameofcollection).document(doc_id).set(data)
+                            # Same fields as the main app's uploads (text_key, random_key, ...), one document per row
+                            new_docs.append((doc_id, prompt_document(data_row, [doc_id], auto_tags[index - 1])))
+                            if len(new_docs) >= 400:
+                                # Each batch counts its own documents in the review counters and Analytics summary
+                                create_documents(db, nameofcollection, new_docs)
+                                new_docs = []
 
                             # Update progress bar
                             progress = int((index / total_rows) * 100)
                             progress_bar.progress(progress)
 
+                        create_documents(db, nameofcollection, new_docs)
+
                     st.success("All data uploaded successfully!")
                     st.session_state.upload_started = False  # Reset the upload state
\ No newline at end of file
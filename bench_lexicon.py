@@ -0,0 +1,85 @@
+"""
+Measures the memory each app process spends on the English word list.
+
+Starts several worker processes (like one Streamlit server per stage app)
+that each load the word list, look every word up so it is fully resident,
+and then report their memory while all of them are still alive:
+
+- "set": the old layout, a Python set of str objects built in every process.
+- "mmap": the memory-mapped lexicon file, shared through the page cache.
+
+RSS counts shared pages in full in every process; PSS (proportional set
+size) splits them between the processes sharing them, so it is the number
+that shows the saving. Linux only (reads /proc/self/smaps_rollup).
+
+Usage:
+    python bench_lexicon.py [--processes N] [--lexicon PATH]
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from lexicon import LEXICON_PATH, Lexicon
+
+
+# Function to read this process's resident and proportional memory in KiB
+def memory_kib():
+    usage = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss"):
+                usage[name] = int(value.split()[0])
+    return usage["Rss"], usage["Pss"]
+
+def worker(mode, path, ready, start, results):
+    rss_before, pss_before = memory_kib()
+    started = time.perf_counter()
+    if mode == "set":
+        # The file is only the source here; the set is what each process would keep
+        words = set(Lexicon.load(path))
+    else:
+        words = Lexicon.load(path)
+    load_seconds = time.perf_counter() - started
+
+    # Look every word up so both layouts are fully paged in
+    found = sum(1 for word in words if word in words)
+    ready.put(found)
+    start.wait()
+    rss_after, pss_after = memory_kib()
+    results.put((load_seconds, rss_after - rss_before, pss_after - pss_before))
+
+def run(mode, path, processes):
+    ctx = multiprocessing.get_context("spawn")
+    ready, results, start = ctx.Queue(), ctx.Queue(), ctx.Event()
+    workers = [ctx.Process(target=worker, args=(mode, path, ready, start, results)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    # Only measure once every process holds its copy, so shared pages are split between all of them
+    for _ in workers:
+        ready.get()
+    start.set()
+    measurements = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+    return measurements
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-process memory of the set and memory-mapped word lists.")
+    parser.add_argument("--processes", type=int, default=4, help="Number of app processes to simulate")
+    parser.add_argument("--lexicon", default=LEXICON_PATH, help="Path of the lexicon file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.lexicon):
+        parser.error(f"{args.lexicon} not found, run `python manage.py build-lexicon` first")
+
+    print(f"{len(Lexicon.load(args.lexicon))} words, {os.path.getsize(args.lexicon) / 1024:.0f} KiB file, {args.processes} processes")
+    print(f"{'layout':<8}{'load ms':>10}{'RSS KiB':>12}{'PSS KiB':>12}   (mean per process)")
+    for mode in ("set", "mmap"):
+        measurements = run(mode, args.lexicon, args.processes)
+        load_ms, rss, pss = (sum(values) / len(values) for values in zip(*measurements))
+        print(f"{mode:<8}{load_ms * 1000:>10.1f}{rss:>12.0f}{pss:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
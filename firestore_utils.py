@@ -0,0 +1,993 @@
+import queue
+import itertools
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore import SERVER_TIMESTAMP, Increment, transactional
+
+# How long a reviewer keeps exclusive hold of a prompt before it goes back to the pool
+LEASE_SECONDS = 15 * 60
+
+# Fields that hand a document back to the pool; merged into every write that finishes a claim
+LEASE_RELEASE = {"claimed_by": None, "lease_expires_at": None}
+
+# Server-set time of the last change to a document's review data; the local
+# mirror's delta sync reads it, so writes that land late (retries, journal
+# replays) are still picked up even though their Timestamp is older
+CHANGE_STAMP = {"updated_at": SERVER_TIMESTAMP}
+
+# Shards per counter and for the Analytics summary; concurrent increments land on different documents
+COUNTER_SHARDS = 10
+
+# What the counter and summary bookkeeping needs to know about a document before a write
+STATE_FIELDS = ["reviewer", "Status", "pulled", "multiplicity"]
+
+
+def lease_is_active(doc_data, now=None):
+    """
+    Checks whether a document is currently claimed by some session.
+
+    Parameters:
+        doc_data (dict): The document fields.
+        now (datetime): Reference time, defaults to the current UTC time.
+
+    Returns:
+        bool: True if the document has a lease that has not expired yet.
+    """
+    expires_at = doc_data.get("lease_expires_at")
+    if not doc_data.get("claimed_by") or expires_at is None:
+        return False
+    return expires_at > (now or datetime.now(timezone.utc))
+
+
+def snapshot_lease_is_active(snapshot, now=None):
+    """
+    `lease_is_active` for a DocumentSnapshot, reading only the lease fields.
+
+    `to_dict()` deep-copies the whole document, which adds up when checking
+    thousands of snapshots; `get()` only copies the field asked for.
+    """
+    lease = {}
+    for field in LEASE_RELEASE:
+        try:
+            lease[field] = snapshot.get(field)
+        except KeyError:
+            lease[field] = None
+    return lease_is_active(lease, now)
+
+
+def claim_document(db, collection, snapshot, claimant, lease_seconds=LEASE_SECONDS):
+    """
+    Marks a document as claimed by `claimant` for `lease_seconds`.
+
+    The write is conditional on the document not having changed since `snapshot`
+    was read, so when two sessions race for the same document only one wins.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection holding the document.
+        snapshot (DocumentSnapshot): The snapshot the claim decision was based on.
+        claimant (str): Who is claiming the document (the reviewer's username).
+        lease_seconds (int): How long the claim is valid.
+
+    Returns:
+        bool: True if the claim went through.
+    """
+    lease = {
+        "claimed_by": claimant,
+        "lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds),
+    }
+    option = db.write_option(last_update_time=snapshot.update_time)
+    try:
+        db.collection(collection).document(snapshot.id).update(lease, option=option)
+    except (FailedPrecondition, NotFound):
+        # Someone else claimed or reviewed it between our read and our write
+        return False
+    return True
+
+
+def renew_lease(db, collection, doc_id, claimant, lease_seconds=LEASE_SECONDS):
+    """
+    Extends a claim `claimant` already holds, e.g. when a prefetched item is finally shown.
+
+    Runs in a transaction, so the lease is only renewed while the document is
+    still pending and claimed by `claimant`. If the old lease ran out and
+    another session took the document, or it was reviewed, nothing is written.
+    A renewal also changes the document's update time, so a session that saw
+    the expired lease and is about to claim the document loses that race.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection holding the document.
+        doc_id (str): The claimed document.
+        claimant (str): Who holds the claim (the reviewer's username).
+        lease_seconds (int): How long the renewed claim is valid.
+
+    Returns:
+        bool: True if the document is still ours, with a fresh lease.
+    """
+    doc_ref = db.collection(collection).document(doc_id)
+
+    @transactional
+    def renew(transaction):
+        data = doc_ref.get(field_paths=["Status", "claimed_by"], transaction=transaction).to_dict() or {}
+        if data.get("Status") != "pending" or data.get("claimed_by") != claimant:
+            return False
+        transaction.update(doc_ref, {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)})
+        return True
+
+    return renew(db.transaction())
+
+
+def pending_candidates(db, collection, limit=50, fields=None):
+    """
+    Fetches pending documents that nobody is holding, in random order.
+
+    Every document carries a uniformly distributed `random_key`. The window
+    starts at a random pivot and wraps around to the start of the key range,
+    so each pending document is equally likely to be picked and concurrent
+    reviewers don't all land on the same first documents.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection to pick from.
+        limit (int): How many pending documents to consider.
+        fields (list): Only fetch these fields (the lease fields are always added).
+
+    Returns:
+        list: DocumentSnapshots of the unleased pending documents.
+    """
+    now = datetime.now(timezone.utc)
+    pending = db.collection(collection).where("Status", "==", "pending")
+    if fields is not None:
+        pending = pending.select(list(dict.fromkeys(fields + list(LEASE_RELEASE))))
+    pivot = random.random()
+    by_key = pending.order_by("random_key")
+    docs = list(by_key.where("random_key", ">=", pivot).limit(limit).stream())
+    if len(docs) < limit:
+        docs += list(by_key.where("random_key", "<", pivot).limit(limit - len(docs)).stream())
+    if not docs:
+        # Documents uploaded before random_key existed are only reachable this way
+        docs = list(pending.limit(limit).stream())
+    candidates = [doc for doc in docs if not lease_is_active(doc.to_dict(), now)]
+    random.shuffle(candidates)
+    return candidates
+
+
+class PendingPool:
+    """
+    In-memory copy of a collection's pending documents, shared by every session
+    of the server process and kept current by a Firestore snapshot listener.
+
+    Handing out candidates then costs no reads; claims still go through
+    `claim_document`, whose precondition is checked against the listener's
+    snapshot, so two processes can't claim the same document either.
+    """
+
+    def __init__(self, db, collection):
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        query = db.collection(collection).where("Status", "==", "pending")
+        self._watch = query.on_snapshot(self._on_snapshot)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    self._docs.pop(change.document.id, None)
+                else:
+                    self._docs[change.document.id] = change.document
+        self._ready.set()
+
+    def is_live(self):
+        """Returns True once the first snapshot arrived and while the listener is running."""
+        return self._ready.is_set() and self._watch.is_active
+
+    def candidates(self, limit):
+        """
+        Picks pending documents that nobody is holding, uniformly at random.
+
+        Parameters:
+            limit (int): Maximum number of documents to return.
+
+        Returns:
+            list: DocumentSnapshots of unleased pending documents.
+        """
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            docs = list(self._docs.values())
+
+        # Sample first and check leases afterwards, so only a few documents are looked at
+        # per call; the rest of the pool is only scanned when most of the sample is held
+        sample = random.sample(docs, min(limit * 4, len(docs)))
+        free = [doc for doc in sample if not snapshot_lease_is_active(doc, now)]
+        if len(free) < limit and len(sample) < len(docs):
+            sampled = {doc.id for doc in sample}
+            rest = [doc for doc in docs if doc.id not in sampled]
+            random.shuffle(rest)
+            for doc in rest:
+                if len(free) >= limit:
+                    break
+                if not snapshot_lease_is_active(doc, now):
+                    free.append(doc)
+        return free[:limit]
+
+    def close(self):
+        self._watch.unsubscribe()
+
+
+def claim_next_pending(db, collection, claimant, limit=50, fields=None):
+    """
+    Claims a random pending document that nobody else is holding.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection to pick from.
+        claimant (str): Who is claiming the document (the reviewer's username).
+        limit (int): How many pending documents to consider.
+        fields (list): Only fetch these fields.
+
+    Returns:
+        DocumentSnapshot: The claimed document as read before the claim, or None if nothing is free.
+    """
+    for doc in pending_candidates(db, collection, limit, fields):
+        if claim_document(db, collection, doc, claimant):
+            return doc
+    return None
+
+
+def chunks(values, size):
+    """Splits a list into consecutive pieces of at most `size` items."""
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def find_decided_duplicates(db, collection, field, values):
+    """
+    Looks up which of `values` already have a reviewed document in one pass.
+
+    Each query combines an `in` on `field` with an `in` on the three decided
+    statuses, so chunks hold 10 values to stay under Firestore's limit of 30
+    disjunctions per query.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection to search.
+        field (str): The field the duplicates share, e.g. "CodeSwitchedText".
+        values (list): The field values to check.
+
+    Returns:
+        dict: Maps each value that has a decided document to that document's data.
+    """
+    decided = {}
+    for chunk in chunks(list(dict.fromkeys(values)), 10):
+        docs = db.collection(collection)\
+            .where(field, "in", chunk)\
+            .where("Status", "in", ["approve", "edit", "reject"])\
+            .select([field, "Status", "reviewed_text", "submission_id"])\
+            .stream()
+        for doc in docs:
+            data = doc.to_dict()
+            decided.setdefault(data[field], data)
+    return decided
+
+
+def commit_updates(db, updates, batch_size=450):
+    """
+    Applies document updates in batches below Firestore's 500-operation limit.
+
+    Parameters:
+        db: Firestore client.
+        updates (iterable): (DocumentReference, dict) pairs to apply.
+        batch_size (int): Operations per batch.
+
+    Returns:
+        int: Number of documents updated.
+    """
+    batch = db.batch()
+    count = 0
+    total = 0
+    for doc_ref, data in updates:
+        batch.update(doc_ref, data)
+        count += 1
+        total += 1
+        if count >= batch_size:
+            batch.commit()
+            batch = db.batch()
+            count = 0
+    if count > 0:
+        batch.commit()
+    return total
+
+
+def find_by_text_keys(db, collection, keys):
+    """
+    Finds one not-yet-pulled document per text_key, used to merge new uploads into.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection to search.
+        keys (list): The text_key values to look up.
+
+    Returns:
+        dict: Maps each key that already has a document to that document's snapshot.
+    """
+    found = {}
+    for chunk in chunks(list(dict.fromkeys(keys)), 30):
+        docs = db.collection(collection)\
+            .where("text_key", "in", chunk)\
+            .where("pulled", "==", False)\
+            .select(["text_key", "member_ids"] + STATE_FIELDS)\
+            .stream()
+        for doc in docs:
+            data = doc.to_dict()
+            # Prefer a document that already is a canonical group over a legacy duplicate
+            if data["text_key"] not in found or "member_ids" in data:
+                found[data["text_key"]] = doc
+    return found
+
+
+def expand_members(doc_id, data):
+    """
+    Expands a canonical document into one record per uploaded prompt it stands for.
+
+    Parameters:
+        doc_id (str): The canonical document ID.
+        data (dict): The canonical document fields.
+
+    Returns:
+        list: (member_id, data) pairs; documents without members expand to themselves.
+    """
+    return [(member_id, data) for member_id in data.get("member_ids") or [doc_id]]
+
+
+
+def fan_out_review(db, collection, docs, data, batch_size=400, workers=8):
+    """
+    Applies the same update to many documents, e.g. one review decision to a
+    duplicate group, together with the counter and summary changes it causes.
+
+    Every batch holds up to `batch_size` documents plus the stats for exactly
+    those documents, so it lands completely or not at all and the counts
+    always match the documents written. Large groups are committed as
+    several batches in parallel (rather than through a BulkWriter, whose
+    writes can't carry their stats atomically). Each of those batches puts
+    its stats on its own counter and summary shard, so the parallel commits
+    don't contend on the same documents.
+
+    A failed batch is not retried here: an error such as DEADLINE_EXCEEDED
+    doesn't say whether the commit landed, and committing the same
+    increments again would count it twice (the client already retries
+    commits that certainly didn't land). The error reaches the caller, and
+    the write is retried from the journal, which reads the documents again
+    and only counts the batches that never landed.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        docs (list): (DocumentReference, document data before the write) pairs.
+        data (dict): The fields to write on every document.
+        batch_size (int): Documents per batch, leaving room for the stats writes.
+        workers (int): Batches committed at once; at most COUNTER_SHARDS so each gets its own shard.
+
+    Returns:
+        int: Number of documents updated.
+    """
+    first_shard = random.randrange(COUNTER_SHARDS)
+
+    def commit_chunk(index, chunk):
+        batch = db.batch()
+        for doc_ref, _ in chunk:
+            batch.update(doc_ref, {**data, **CHANGE_STAMP})
+        old_docs = [old for _, old in chunk]
+        shard = (first_shard + index) % COUNTER_SHARDS
+        add_review_stats(batch, db, collection, old_docs, [{**old, **data} for old in old_docs], shard=shard)
+        batch.commit()
+        return len(chunk)
+
+    doc_chunks = chunks(list(docs), batch_size)
+    if len(doc_chunks) <= 1:
+        return sum(commit_chunk(index, chunk) for index, chunk in enumerate(doc_chunks))
+    with ThreadPoolExecutor(max_workers=min(workers, COUNTER_SHARDS, len(doc_chunks))) as pool:
+        return sum(pool.map(commit_chunk, range(len(doc_chunks)), doc_chunks))
+
+
+def auto_sync_duplicate(db, collection, snapshot, decided):
+    """
+    Copies a decision already made on a twin onto a pending duplicate, with its
+    counter and summary changes in the same batch.
+
+    The write is conditional on the document not having changed since
+    `snapshot` was read. A stale pool snapshot, or two sessions syncing the
+    same duplicate, therefore can't apply (and count) it twice.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        snapshot (DocumentSnapshot): The pending duplicate, as read.
+        decided (dict): The decided twin's data (Status, reviewed_text, submission_id).
+
+    Returns:
+        bool: True if this write landed.
+    """
+    old = snapshot.to_dict() or {}
+    update = {
+        "Status": decided["Status"],
+        "reviewed_text": decided.get("reviewed_text"),
+        "reviewer": "System-AutoSync",
+        "submission_id": decided.get("submission_id"),  # Undoing that submission reverts this copy too
+        "Timestamp": datetime.utcnow(),
+        **LEASE_RELEASE
+    }
+    batch = db.batch()
+    batch.update(snapshot.reference, {**update, **CHANGE_STAMP}, option=db.write_option(last_update_time=snapshot.update_time))
+    add_review_stats(batch, db, collection, [old], [{**old, **update}])
+    try:
+        batch.commit()
+    except (FailedPrecondition, NotFound):
+        # Someone else synced, claimed or reviewed it after we read it
+        return False
+    return True
+
+
+def create_documents(db, collection, docs, batch_size=400):
+    """
+    Creates documents (e.g. uploaded prompts) with their counter and summary
+    changes in the same batches, so a partial upload is still counted right.
+    A document that already exists is overwritten and its old state uncounted,
+    so uploading the same IDs twice doesn't count them twice.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        docs (list): (doc_id, data) pairs.
+        batch_size (int): Documents per batch.
+
+    Returns:
+        int: Number of documents created.
+    """
+    for chunk in chunks(list(docs), batch_size):
+        doc_refs = [db.collection(collection).document(doc_id) for doc_id, _ in chunk]
+        old_docs = [doc.to_dict() for doc in db.get_all(doc_refs, field_paths=STATE_FIELDS) if doc.exists]
+        batch = db.batch()
+        for doc_ref, (_, data) in zip(doc_refs, chunk):
+            batch.set(doc_ref, {**data, **CHANGE_STAMP})
+        add_review_stats(batch, db, collection, old_docs, [data for _, data in chunk])
+        batch.commit()
+    return len(docs)
+
+
+class WriteBehindQueue:
+    """
+    Applies Firestore writes on a background worker so reviewers don't wait for them.
+
+    Each owner gets their own queue and worker. An owner's writes run one at
+    a time in submission order, so an undo queued after a review is applied
+    after it, while other owners' writes carry on in parallel. Failed writes
+    are retried with exponential backoff; after `max_attempts` they are kept
+    as failures until retried or dismissed.
+    """
+
+    def __init__(self, max_attempts=5, backoff_seconds=1.0):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._queues = {}
+        self._items = {}
+        self._lock = threading.Lock()
+
+    # Function to get an owner's queue, starting its worker on first use
+    def _queue_for(self, owner):
+        with self._lock:
+            owner_queue = self._queues.get(owner)
+            if owner_queue is None:
+                owner_queue = self._queues[owner] = queue.Queue()
+                threading.Thread(target=self._run, args=(owner_queue,), daemon=True).start()
+            return owner_queue
+
+    def submit(self, owner, label, func, *args, ref=None):
+        """
+        Queues `func(*args)` to be applied in the background.
+
+        Parameters:
+            owner (str): Who the write belongs to (the reviewer's username).
+            label (str): Short description shown when the write fails.
+            func (callable): The write to apply.
+            *args: Arguments for `func`.
+            ref: The caller's own ID for the write (e.g. its journal entry), returned with failures.
+
+        Returns:
+            str: ID of the queued item.
+        """
+        item_id = uuid.uuid4().hex
+        with self._lock:
+            self._items[item_id] = {
+                "id": item_id, "owner": owner, "label": label, "func": func, "args": args, "ref": ref,
+                "attempts": 0, "error": None, "failed": False,
+            }
+        self._queue_for(owner).put(item_id)
+        return item_id
+
+    def _run(self, owner_queue):
+        while True:
+            item_id = owner_queue.get()
+            try:
+                self._apply(item_id)
+            except Exception as e:
+                # Never let one bad item stop the worker, or the owner's later writes would stay pending
+                print(f"Write-behind worker skipped item {item_id}: {e}")
+
+    def _apply(self, item_id):
+        with self._lock:
+            item = self._items.get(item_id)
+            # Dismissed, or queued twice and already given up on
+            if item is None or item["failed"]:
+                return
+        while True:
+            try:
+                item["func"](*item["args"])
+            except Exception as e:
+                with self._lock:
+                    item["attempts"] += 1
+                    item["error"] = str(e)
+                    if item["attempts"] >= self.max_attempts:
+                        item["failed"] = True
+                        return
+                    delay = self.backoff_seconds * 2 ** (item["attempts"] - 1)
+                # Retry in place so the owner's later writes (e.g. an undo) stay behind this one;
+                # only this owner's worker waits
+                time.sleep(delay)
+            else:
+                with self._lock:
+                    self._items.pop(item_id, None)
+                return
+
+    def pending_count(self, owner):
+        """Returns how many of `owner`'s writes have not been applied yet (failures excluded)."""
+        with self._lock:
+            return sum(1 for item in self._items.values() if item["owner"] == owner and not item["failed"])
+
+    def failures(self, owner):
+        """Returns `owner`'s writes that ran out of attempts, as dicts with id, label, error and ref."""
+        with self._lock:
+            return [
+                {"id": item["id"], "label": item["label"], "error": item["error"], "ref": item["ref"]}
+                for item in self._items.values()
+                if item["owner"] == owner and item["failed"]
+            ]
+
+    def retry(self, item_id):
+        """Puts a failed write back on the queue with a fresh set of attempts."""
+        with self._lock:
+            item = self._items.get(item_id)
+            # Already dismissed, or retried and back on the queue
+            if item is None or not item["failed"]:
+                return
+            item["attempts"] = 0
+            item["failed"] = False
+            owner = item["owner"]
+        self._queue_for(owner).put(item_id)
+
+    def dismiss(self, item_id):
+        """Drops a failed write for good."""
+        with self._lock:
+            self._items.pop(item_id, None)
+
+
+def counters_collection(collection):
+    """Name of the collection holding the sharded counters for `collection`."""
+    return f"{collection}_counters"
+
+
+def counter_id(kind, name):
+    """ID of the counter for a reviewer (kind "reviewer") or a status (kind "status")."""
+    return f"{kind}:{name}".replace("/", "_")
+
+
+def doc_weight(data):
+    """
+    How many uploaded prompts a document stands for.
+
+    A canonical document counts once per copy in its `member_ids`, so the
+    counters and the Analytics summary keep counting prompts, the same as
+    for older groups stored as one document per copy.
+    """
+    return data.get("multiplicity") or 1
+
+
+def doc_state(data):
+    """The (reviewer, Status, weight) of a document, which is what the counters track."""
+    return data.get("reviewer"), data.get("Status"), doc_weight(data)
+
+
+def state_counts(states):
+    """
+    Tallies (reviewer, Status, weight) triples into counter totals.
+
+    Returns:
+        Counter: Maps (kind, name) to the number of prompts.
+    """
+    counts = Counter()
+    for reviewer, status, weight in states:
+        if reviewer:
+            counts[("reviewer", reviewer)] += weight
+        if status:
+            counts[("status", status)] += weight
+    return counts
+
+
+def counter_deltas(old_states, new_states):
+    """
+    Works out how the counters change when documents go from `old_states` to `new_states`.
+
+    A document whose state does not change contributes nothing, which keeps
+    replays of an already-applied write from counting it twice.
+
+    Returns:
+        dict: Maps (kind, name) to a non-zero change.
+    """
+    deltas = state_counts(new_states)
+    deltas.subtract(state_counts(old_states))
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def add_counter_deltas(batch, db, collection, deltas, shard=None):
+    """Adds the increments for `deltas` to `batch`, each on `shard` or a random one."""
+    counters = db.collection(counters_collection(collection))
+    for (kind, name), delta in deltas.items():
+        shard_ref = counters.document(f"{counter_id(kind, name)}-{random.randrange(COUNTER_SHARDS) if shard is None else shard}")
+        batch.set(shard_ref, {"counter": counter_id(kind, name), "count": Increment(delta)}, merge=True)
+
+
+def read_counter(db, collection, kind, name):
+    """
+    Reads a counter by summing its shards (at most COUNTER_SHARDS small documents).
+
+    Parameters:
+        db: Firestore client.
+        collection (str): The review collection the counter belongs to.
+        kind (str): "reviewer" or "status".
+        name (str): The reviewer's username or the status.
+
+    Returns:
+        int: The counter's value.
+    """
+    shards = db.collection(counters_collection(collection))\
+        .where("counter", "==", counter_id(kind, name))\
+        .select(["count"])\
+        .stream()
+    return sum(shard.to_dict().get("count", 0) for shard in shards)
+
+
+def summary_ref(db, collection, shard):
+    """One of the COUNTER_SHARDS documents the Analytics summary of `collection` is split over."""
+    return db.collection(f"{collection}_summary").document(f"analytics-{shard}")
+
+
+def summary_refs(db, collection):
+    """Every document holding part of the Analytics summary, including the unsharded one older versions wrote."""
+    summaries = db.collection(f"{collection}_summary")
+    return [summaries.document("analytics")] + [summary_ref(db, collection, shard) for shard in range(COUNTER_SHARDS)]
+
+
+def summary_key(data):
+    """
+    The (reviewer, Status) cell of the Analytics summary a document falls in.
+
+    Mirrors how Analytics always bucketed documents: unreviewed ones under
+    "unreviewed", reviewer names stripped, pulled documents left out.
+
+    Returns:
+        tuple: (reviewer, status), or None for pulled documents.
+    """
+    if data.get("pulled", False):
+        return None
+    return (data.get("reviewer") or "unreviewed").strip(), data.get("Status") or "unreviewed"
+
+
+def summary_deltas(old_docs, new_docs):
+    """
+    Works out how the summary cells change when documents go from `old_docs` to `new_docs`.
+
+    Returns:
+        dict: Maps (reviewer, status) to a non-zero change in prompts.
+    """
+    deltas = summary_counts(new_docs)
+    deltas.subtract(summary_counts(old_docs))
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def summary_counts(docs):
+    """Tallies documents into summary cells, each weighted by the prompts it stands for."""
+    counts = Counter()
+    for data in docs:
+        key = summary_key(data)
+        if key:
+            counts[key] += doc_weight(data)
+    return counts
+
+
+def add_summary_deltas(batch, db, collection, deltas, shard=None):
+    """Adds the increments for `deltas` to `batch` as one merge into summary shard `shard`, or a random one."""
+    if deltas:
+        counts = {}
+        for (reviewer, status), delta in deltas.items():
+            counts.setdefault(reviewer, {})[status] = Increment(delta)
+        if shard is None:
+            shard = random.randrange(COUNTER_SHARDS)
+        batch.set(summary_ref(db, collection, shard), {"counts": counts}, merge=True)
+
+
+def add_review_stats(batch, db, collection, old_docs, new_docs, shard=None):
+    """
+    Adds the counter and summary updates for documents changing from `old_docs` to
+    `new_docs` (lists of document data, before and after the write) to `batch`,
+    on shard `shard` (random by default).
+    """
+    add_counter_deltas(batch, db, collection, counter_deltas(map(doc_state, old_docs), map(doc_state, new_docs)), shard)
+    add_summary_deltas(batch, db, collection, summary_deltas(old_docs, new_docs), shard)
+
+
+def read_summary(db, collection):
+    """
+    Reads the Analytics summary by adding up its shards (COUNTER_SHARDS + 1 small documents).
+
+    Returns:
+        dict: Maps reviewer to a dict of status to number of prompts.
+    """
+    counts = {}
+    for snapshot in db.get_all(summary_refs(db, collection)):
+        for reviewer, statuses in ((snapshot.to_dict() or {}).get("counts") or {}).items():
+            for status, count in statuses.items():
+                counts.setdefault(reviewer, {})[status] = counts.get(reviewer, {}).get(status, 0) + count
+    return counts
+
+
+def rebuild_summary(db, collection):
+    """
+    Recomputes the Analytics summary from the documents and overwrites it.
+
+    The totals are written to shard 0 and every other shard (and the
+    unsharded document older versions wrote) is cleared.
+
+    Returns:
+        dict: The new summary counts.
+    """
+    docs = db.collection(collection).select(STATE_FIELDS).stream()
+    counts = {}
+    for (reviewer, status), total in summary_counts(doc.to_dict() for doc in docs).items():
+        counts.setdefault(reviewer, {})[status] = total
+    batch = db.batch()
+    shard_0 = summary_ref(db, collection, 0)
+    for ref in summary_refs(db, collection):
+        if ref.id != shard_0.id:
+            batch.delete(ref)
+    batch.set(shard_0, {"counts": counts})
+    batch.commit()
+    return counts
+
+
+def rebuild_counters(db, collection):
+    """
+    Recomputes every counter from the documents themselves.
+
+    Existing shards are zeroed and each total is written to shard 0. Reviews
+    saved while this runs can be missed, so run it when nobody is reviewing.
+
+    Returns:
+        dict: The recomputed totals, keyed by (kind, name).
+    """
+    docs = db.collection(collection).select(["reviewer", "Status", "multiplicity"]).stream()
+    totals = state_counts(doc_state(doc.to_dict()) for doc in docs)
+
+    counters = db.collection(counters_collection(collection))
+    writes = [(shard.reference, {"count": 0}) for shard in counters.select([]).stream()]
+    writes += [
+        (counters.document(f"{counter_id(kind, name)}-0"), {"counter": counter_id(kind, name), "count": total})
+        for (kind, name), total in totals.items()
+    ]
+    batch = db.batch()
+    for i, (shard, data) in enumerate(writes, start=1):
+        batch.set(shard, data, merge=True)
+        if i % 450 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    return dict(totals)
+
+
+def apply_review(db, collection, doc_id, review_data, original_text_key):
+    """
+    Writes a review decision to a document and all other pending documents
+    that share its original text (same text_key).
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        doc_id (str): The reviewed document.
+        review_data (dict): The decision, including its Timestamp.
+        original_text_key (str): text_key of the text as uploaded.
+
+    Returns:
+        int: Number of documents updated.
+    """
+    review_data = {**review_data, **LEASE_RELEASE}  # The decision hands the document back, so drop the lease
+
+    # 1. Add the current document explicitly 
+    # (in case the query below misses it due to latency or specific filters)
+    current_doc = db.collection(collection).document(doc_id).get(field_paths=STATE_FIELDS)
+    docs = [(current_doc.reference, current_doc.to_dict() or {})]
+
+    # 2. Query for ALL pending documents with the same normalized text
+    duplicates = db.collection(collection)\
+        .where("text_key", "==", original_text_key)\
+        .where("Status", "==", "pending")\
+        .select(STATE_FIELDS)\
+        .stream()
+
+    for doc in duplicates:
+        # Skip the current doc_id because we already added it above
+        if doc.id == doc_id:
+            continue
+        docs.append((doc.reference, doc.to_dict()))
+
+    # 3. Write the decision (and its counts) to all of them, in parallel for large groups
+    return fan_out_review(db, collection, docs, review_data)
+
+
+def edited_tag_fields(data, edited_text):
+    """
+    The language tag fields of a document whose reviewed text is replaced.
+
+    The stored languages are kept (run-length encoded) when they still cover
+    exactly the words of the new text, e.g. after a spelling fix. Otherwise
+    both formats are cleared, and readers fall back to the automatic tags of
+    the new text instead of pairing words with the wrong languages.
+
+    Parameters:
+        data (dict): The document, with its language_tags and language_tags_rle.
+        edited_text (str): The new reviewed text.
+
+    Returns:
+        dict: Values for language_tags_rle and language_tags.
+    """
+    runs = data.get("language_tags_rle")
+    if runs is None and data.get("language_tags"):
+        languages = (entry["language"] for entry in data["language_tags"])
+        runs = " ".join(f"{language}:{sum(1 for _ in run)}" for language, run in itertools.groupby(languages))
+    counts = [run.rpartition(":")[2] for run in (runs or "").split()]
+    if runs and all(count.isdigit() for count in counts) and sum(map(int, counts)) == len(edited_text.split()):
+        return {"language_tags_rle": runs, "language_tags": None}
+    return {"language_tags_rle": None, "language_tags": None}
+
+
+def apply_update(db, collection, doc_id, edited_text, timestamp):
+    """Replaces the reviewed text of a document, marking it as an edit and keeping its language tags in step."""
+    doc_ref = db.collection(collection).document(doc_id)
+    old_data = doc_ref.get(field_paths=STATE_FIELDS + ["language_tags", "language_tags_rle"]).to_dict() or {}
+    batch = db.batch()
+    batch.update(doc_ref, {
+        "reviewed_text": edited_text,
+        "Timestamp": timestamp,
+        "Status": "edit",
+        **edited_tag_fields(old_data, edited_text),
+        **CHANGE_STAMP
+    })
+    add_review_stats(batch, db, collection, [old_data], [{**old_data, "Status": "edit"}])
+    batch.commit()
+
+
+def apply_undo(db, collection, doc_id, timestamp):
+    """Undoes the submission a reviewed document belongs to, see `apply_bulk_undo`."""
+    return apply_bulk_undo(db, collection, [doc_id], timestamp)
+
+
+def apply_bulk_undo(db, collection, doc_ids, timestamp):
+    """
+    Puts reviewed documents back in the pending pool, together with every other
+    document their submissions wrote.
+
+    A review fans out to all pending duplicates and auto-syncs copy it to
+    later ones, all under the same `submission_id`. Undoing only the reviewed
+    document would leave those approved, and the next auto-sync would flip it
+    straight back. Documents from before submission IDs existed are reset on
+    their own. Members of a submission that were already pulled into the
+    speech app are left alone, so they don't go back into the review pool.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        doc_ids (list): The documents picked for undo.
+        timestamp (datetime): When the undo was requested.
+
+    Returns:
+        int: Number of documents reset.
+    """
+    doc_refs = [db.collection(collection).document(doc_id) for doc_id in doc_ids]
+    selected = list(db.get_all(doc_refs, field_paths=STATE_FIELDS + ["submission_id"]))
+
+    docs = {doc.id: doc for doc in selected if doc.exists}
+    submission_ids = [doc.to_dict().get("submission_id") for doc in docs.values()]
+    for chunk in chunks(list(dict.fromkeys(sid for sid in submission_ids if sid)), 30):
+        group = db.collection(collection)\
+            .where("submission_id", "in", chunk)\
+            .select(STATE_FIELDS)\
+            .stream()
+        for doc in group:
+            if not doc.to_dict().get("pulled", False):
+                docs.setdefault(doc.id, doc)
+
+    reset = {
+        "Timestamp": timestamp,
+        "Status": "pending",
+        "reviewer": None,
+        "submission_id": None,
+        **LEASE_RELEASE
+    }
+    return fan_out_review(db, collection, [(doc.reference, doc.to_dict()) for doc in docs.values()], reset)
+
+
+def write_is_stale(db, collection, doc_ids, timestamp):
+    """
+    Checks whether a journaled write has been overtaken by newer writes to its documents.
+
+    Every review, undo and auto-sync stamps the documents it writes with its
+    own Timestamp, so a document with a newer Timestamp than the write's has
+    had a later decision. Documents carrying the write's own Timestamp (a
+    write that partly landed) or an older one are fine to (re)write.
+
+    Parameters:
+        db: Firestore client.
+        collection (str): Name of the collection.
+        doc_ids (list): The documents the write targets.
+        timestamp (datetime): The Timestamp the write sets (naive means UTC).
+
+    Returns:
+        bool: True if any of the documents has a newer Timestamp.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    refs = [db.collection(collection).document(doc_id) for doc_id in doc_ids]
+    for snapshot in db.get_all(refs, field_paths=["Timestamp"]):
+        current = (snapshot.to_dict() or {}).get("Timestamp")
+        if current is not None and current > timestamp:
+            return True
+    return False
+
+
+def stale_write_checks(db, collection):
+    """
+    Maps the journaled write names to checks for `journal.replay_entry`, see `write_is_stale`.
+
+    Returns:
+        dict: Functions taking a journal entry and returning True when it has been overtaken.
+    """
+    return {
+        "save_review": lambda entry: write_is_stale(
+            db, collection, [entry["payload"]["doc_id"]], entry["payload"]["review_data"]["Timestamp"]),
+        "update_review": lambda entry: write_is_stale(
+            db, collection, [entry["payload"]["doc_id"]], entry["payload"]["timestamp"]),
+        "undo_review": lambda entry: write_is_stale(
+            db, collection, [entry["payload"]["doc_id"]], entry["payload"]["timestamp"]),
+        "undo_reviews": lambda entry: write_is_stale(
+            db, collection, entry["payload"]["doc_ids"], entry["payload"]["timestamp"]),
+    }
+
+
+def review_writes(db, collection):
+    """
+    Maps the journaled write names to the functions that apply them to `collection`.
+
+    Returns:
+        dict: Handlers for `journal.apply_entry` and `journal.replay`.
+    """
+    return {
+        "save_review": lambda **payload: apply_review(db, collection, **payload),
+        "update_review": lambda **payload: apply_update(db, collection, **payload),
+        "undo_review": lambda **payload: apply_undo(db, collection, **payload),
+        "undo_reviews": lambda **payload: apply_bulk_undo(db, collection, **payload),
+    }
@@ -0,0 +1,193 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+
+def _encode(value):
+    # JSON has no datetime type, so timestamps are tagged and restored on load
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Cannot journal value of type {type(value).__name__}")
+
+
+def _decode(obj):
+    if set(obj) == {"$datetime"}:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+class ReviewJournal:
+    """
+    Local SQLite write-ahead journal of review writes.
+
+    Every write is recorded here before it is sent to Firestore and marked as
+    applied once Firestore accepted it. After a crash, restart or Firestore
+    outage, the entries that were never applied can be replayed in their
+    original order. The writes are idempotent (they set absolute values), so
+    replaying an entry that did reach Firestore is harmless.
+
+    Entries the reviewer gave up on (a dismissed write-behind failure, or a
+    failed write they were shown and can submit again) are marked as
+    abandoned and never replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                owner TEXT,
+                created_at TEXT NOT NULL,
+                applied_at TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+        # Journals created before entries could be abandoned
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(entries)")]
+        if "abandoned_at" not in columns:
+            self._conn.execute("ALTER TABLE entries ADD COLUMN abandoned_at TEXT")
+
+    def record(self, op, payload, owner=None):
+        """
+        Records a write before it is applied.
+
+        Parameters:
+            op (str): Name of the write, e.g. "save_review".
+            payload (dict): Keyword arguments for the write.
+            owner (str): Who made the write (the reviewer's username).
+
+        Returns:
+            int: ID of the journal entry.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO entries (op, payload, owner, created_at) VALUES (?, ?, ?, ?)",
+                (op, json.dumps(payload, default=_encode), owner, datetime.utcnow().isoformat()),
+            )
+            return cursor.lastrowid
+
+    def mark_applied(self, entry_id):
+        """Marks an entry as written to Firestore."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET applied_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (datetime.utcnow().isoformat(), entry_id),
+            )
+
+    def mark_failed(self, entry_id, error):
+        """Records a failed attempt at applying an entry."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (str(error), entry_id),
+            )
+
+    def mark_abandoned(self, entry_id):
+        """Marks an entry as given up on, so it is never replayed."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET abandoned_at = ? WHERE id = ? AND applied_at IS NULL",
+                (datetime.utcnow().isoformat(), entry_id),
+            )
+
+    def unapplied(self):
+        """
+        Lists the entries that have not reached Firestore yet and were not abandoned, oldest first.
+
+        Returns:
+            list: Dicts with id, op, payload and owner.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, op, payload, owner FROM entries"
+                " WHERE applied_at IS NULL AND abandoned_at IS NULL ORDER BY id"
+            ).fetchall()
+        return [
+            {"id": entry_id, "op": op, "payload": json.loads(payload, object_hook=_decode), "owner": owner}
+            for entry_id, op, payload, owner in rows
+        ]
+
+
+def apply_entry(journal, handlers, entry_id, op, payload):
+    """
+    Applies one journaled write and records the outcome.
+
+    Parameters:
+        journal (ReviewJournal): The journal the entry belongs to.
+        handlers (dict): Maps each op name to the function that applies it.
+        entry_id (int): ID of the journal entry.
+        op (str): Name of the write.
+        payload (dict): Keyword arguments for the handler.
+
+    Returns:
+        The handler's return value.
+    """
+    try:
+        result = handlers[op](**payload)
+    except Exception as e:
+        journal.mark_failed(entry_id, e)
+        raise
+    journal.mark_applied(entry_id)
+    return result
+
+
+def replay_entry(journal, handlers, stale_checks, entry):
+    """
+    Applies an entry from `ReviewJournal.unapplied`, unless it has been overtaken.
+
+    A replay can run long after the write was made. If the documents it
+    touches got a newer decision since (e.g. the prompt was reviewed again
+    or undone), applying it would overwrite that decision, so it is marked
+    as abandoned instead.
+
+    Parameters:
+        journal (ReviewJournal): The journal the entry belongs to.
+        handlers (dict): Maps each op name to the function that applies it.
+        stale_checks (dict): Maps op names to a function taking the entry and
+            returning True when it has been overtaken.
+        entry (dict): The entry to replay.
+
+    Returns:
+        bool: True if the entry was applied, False if it was abandoned.
+    """
+    check = stale_checks.get(entry["op"])
+    if check is not None and check(entry):
+        print(f"Abandoned journal entry {entry['id']} ({entry['op']}): its documents got a newer decision since it was recorded")
+        journal.mark_abandoned(entry["id"])
+        return False
+    apply_entry(journal, handlers, entry["id"], entry["op"], entry["payload"])
+    return True
+
+
+def replay(journal, handlers, stale_checks=None):
+    """
+    Applies every unapplied entry in order, stopping at the first failure so later
+    writes (e.g. an undo) never overtake the ones before them.
+
+    Parameters:
+        journal (ReviewJournal): The journal to replay.
+        handlers (dict): Maps each op name to the function that applies it.
+        stale_checks (dict): See `replay_entry`.
+
+    Returns:
+        tuple: (number of entries applied, number abandoned, number still unapplied).
+    """
+    entries = journal.unapplied()
+    applied = abandoned = 0
+    for entry in entries:
+        try:
+            if replay_entry(journal, handlers, stale_checks or {}, entry):
+                applied += 1
+            else:
+                abandoned += 1
+        except Exception as e:
+            print(f"Replay stopped at journal entry {entry['id']} ({entry['op']}): {e}")
+            break
+    return applied, abandoned, len(entries) - applied - abandoned
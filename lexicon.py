@@ -0,0 +1,131 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# Prebuilt English word list the tagger looks words up in (see `python manage.py build-lexicon`)
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "english_words.lex")
+LEXICON_MAGIC = b"LEX2"
+_HEADER = struct.Struct("<4sIH")
+
+
+class Lexicon:
+    """
+    Read-only sorted word list stored in a single file.
+
+    The file is a header (magic, word count and the length of the source
+    description), the source description padded to 4 bytes, `count + 1`
+    little-endian uint32 offsets and the UTF-8 words back to back in byte
+    order. The source says which word list the file was built from. It is
+    memory-mapped read-only rather than read, so nothing is parsed or copied
+    at load and every process on the host (one per stage app) shares the
+    same physical pages through the page cache. Membership tests
+    (`word in lexicon`) are a binary search over the offsets, so it replaces
+    a set of str objects built in each process at startup.
+    """
+
+    def __init__(self, data):
+        magic, count, source_length = _HEADER.unpack_from(data, 0)
+        if magic != LEXICON_MAGIC:
+            raise ValueError(f"Not a lexicon file or an outdated one (magic {magic!r}), rebuild it with `python manage.py build-lexicon`")
+        self.source = bytes(data[_HEADER.size:_HEADER.size + source_length]).decode("utf-8")
+        self._count = count
+        offsets_start = _offsets_start(source_length)
+        self._blob_start = offsets_start + 4 * (count + 1)
+        if sys.byteorder == "little":
+            # Read the offsets in place, so they stay in the shared mapping too
+            self._offsets = memoryview(data)[offsets_start:self._blob_start].cast("I")
+        else:
+            self._offsets = array("I")
+            self._offsets.frombytes(data[offsets_start:self._blob_start])
+            self._offsets.byteswap()
+        self._data = data
+
+    @classmethod
+    def load(cls, path=LEXICON_PATH):
+        with open(path, "rb") as f:
+            # The mapping stays valid after the file is closed
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self._count
+
+    def _word(self, i):
+        return self._data[self._blob_start + self._offsets[i]:self._blob_start + self._offsets[i + 1]]
+
+    def __contains__(self, word):
+        if not isinstance(word, str):
+            return False
+        key = word.encode("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self._count and self._word(lo) == key
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._word(i).decode("utf-8")
+
+
+def _offsets_start(source_length):
+    # The offsets start on a 4-byte boundary after the source description
+    return (_HEADER.size + source_length + 3) // 4 * 4
+
+
+def build_lexicon(words, path=LEXICON_PATH, source=""):
+    """
+    Writes a lexicon file.
+
+    Only lowercase entries are kept: the tagger lowercases every word before
+    looking it up, so capitalized entries (proper nouns) could never match.
+
+    Parameters:
+        words (iterable): The words to store.
+        path (str): Where to write the file.
+        source (str): Which word list (and version) the words come from, stored in the header.
+
+    Returns:
+        int: Number of words written.
+    """
+    encoded = sorted({word.encode("utf-8") for word in words if word == word.lower()})
+    offsets = array("I", [0])
+    for word in encoded:
+        offsets.append(offsets[-1] + len(word))
+    if sys.byteorder != "little":
+        offsets.byteswap()
+
+    # Write to a temporary file first so running apps never see a half-written lexicon
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        source_bytes = source.encode("utf-8")
+        f.write(_HEADER.pack(LEXICON_MAGIC, len(encoded), len(source_bytes)))
+        f.write(source_bytes.ljust(_offsets_start(len(source_bytes)) - _HEADER.size, b"\0"))
+        f.write(offsets.tobytes())
+        f.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+    return len(encoded)
+
+
+def load_english_words(path=LEXICON_PATH):
+    """
+    Loads the English word list used by `light_tagger`.
+
+    The lexicon file is committed with the code, so the apps start without
+    network access. A missing file is an error rather than a reason to fetch
+    a word list, which could silently differ from the one the file was built
+    from.
+
+    Parameters:
+        path (str): Path of the lexicon file.
+
+    Returns:
+        Lexicon: Supports `word in english_words`.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"English lexicon {path} not found, rebuild it with `python manage.py build-lexicon`")
+    return Lexicon.load(path)
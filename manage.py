@@ -0,0 +1,192 @@
+"""
+Maintenance commands for the review collections.
+
+Usage:
+    python manage.py [--collection NAME] <command>
+
+Run `python manage.py --help` for the list of commands.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+from firebase_admin import credentials, firestore, initialize_app, _apps
+from firestore_utils import commit_updates, expand_members, review_writes, stale_write_checks, rebuild_counters, rebuild_summary
+from journal import ReviewJournal, replay
+from lexicon import LEXICON_PATH, Lexicon, build_lexicon
+from mirror import ReviewMirror
+from utils import text_key, light_tagger_batch, LANGUAGES, encode_tags, reverse_tag, tag, document_tags
+
+
+# Initialize Firebase only when a command actually needs it
+def get_db():
+    firebase_secrets = json.loads(os.environ['firebase_credentials'])
+    if not _apps:
+        cred = credentials.Certificate(firebase_secrets)
+        initialize_app(cred)
+    return firestore.client()
+
+# Function to set `text_key` on every document that is missing it or has a stale one
+def backfill_text_keys(db, collection):
+    docs = db.collection(collection).select(["CodeSwitchedText", "text_key"]).stream()
+    updates = []
+    for doc in docs:
+        data = doc.to_dict()
+        key = text_key(data.get("CodeSwitchedText") or "")
+        if data.get("text_key") != key:
+            updates.append((doc.reference, {"text_key": key}))
+    return commit_updates(db, updates)
+
+# Function to store the light_tagger tags (one language per word) on every document without them
+def backfill_language_tags(db, collection):
+    docs = [
+        doc for doc in db.collection(collection).select(["CodeSwitchedText", "auto_language_tags"]).stream()
+        if doc.to_dict().get("auto_language_tags") is None
+    ]
+    # The Review page tags the text with its surrounding quotes stripped, so do the same here
+    texts = [str(doc.to_dict().get("CodeSwitchedText") or "").strip('"') for doc in docs]
+    updates = [
+        (doc.reference, {"auto_language_tags": [LANGUAGES[code] for code in tags]})
+        for doc, tags in zip(docs, light_tagger_batch(texts))
+    ]
+    return commit_updates(db, updates)
+
+# Function to move reviews from the legacy per-word language_tags to the run-length encoded language_tags_rle
+def migrate_language_tags(db, collection):
+    docs = db.collection(collection).select(["reviewed_text", "language_tags", "language_tags_rle"]).stream()
+    updates = []
+    skipped = 0
+    for doc in docs:
+        data = doc.to_dict()
+        if not data.get("language_tags") or data.get("language_tags_rle") is not None:
+            continue
+        word_tags = reverse_tag(data["language_tags"])
+        if [word for word, _ in word_tags] != (data.get("reviewed_text") or "").split():
+            # The tags don't line up with the reviewed text (e.g. it was edited afterwards), keep them as they are
+            skipped += 1
+            continue
+        updates.append((doc.reference, {"language_tags_rle": encode_tags(word_tags), "language_tags": firestore.DELETE_FIELD}))
+    return commit_updates(db, updates), skipped
+
+# Function to give every document without one a random_key for uniform sampling
+def backfill_random_keys(db, collection):
+    docs = db.collection(collection).select(["random_key"]).stream()
+    updates = [
+        (doc.reference, {"random_key": random.random()})
+        for doc in docs
+        if doc.to_dict().get("random_key") is None
+    ]
+    return commit_updates(db, updates)
+
+# Function to export reviewed prompts, one row per uploaded prompt (canonical documents are expanded).
+# Reads Firestore rather than the local mirror, which can lag behind changes made outside the apps (e.g. `pulled`)
+def export_reviews(db, collection, output_file, include_pulled=False):
+    export_fields = ["CodeSwitchedText", "reviewed_text", "Status", "reviewer", "emotions", "domain", "language_tags", "Timestamp"]
+    docs = db.collection(collection)\
+        .where("Status", "in", ["approve", "edit"])\
+        .select(export_fields + ["language_tags_rle", "member_ids", "pulled"])\
+        .stream()
+    count = 0
+    with open(output_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ID", "CanonicalID"] + export_fields)
+        for doc in sorted(docs, key=lambda doc: doc.id):
+            doc_id, data = doc.id, doc.to_dict()
+            if data.get("pulled", False) and not include_pulled:
+                continue
+            row = [data.get(field) for field in export_fields]
+            # Exported in the legacy per-word format whichever way the document stores them
+            row[export_fields.index("language_tags")] = json.dumps(tag(document_tags(data)), ensure_ascii=False)
+            for member_id, _ in expand_members(doc_id, data):
+                writer.writerow([member_id, doc_id] + row)
+                count += 1
+    return count
+
+# Function to rebuild the English lexicon file from a locally installed word list, recording which one in its header
+def build_english_lexicon(output_file, source="web2"):
+    if source == "web2":
+        # Webster's 2nd International as packaged by english-words (in requirements.txt)
+        from english_words import get_english_words_set
+        from english_words.version import VERSION
+        return build_lexicon(get_english_words_set(["web2"]), output_file, f"web2 (english-words {VERSION})")
+    import nltk
+    from nltk.corpus import words
+    return build_lexicon(words.words(), output_file, f"nltk words corpus (nltk {nltk.__version__})")
+
+# Function to compare a lexicon file with the NLTK word corpus light_tagger used before the lexicon existed.
+# The tagger lowercases every word before looking it up, so only lowercase entries can ever match: a word
+# is tagged differently by the two lists exactly when it is in one of the returned lists
+def compare_lexicon_with_nltk(path):
+    from nltk.corpus import words
+    lexicon_words = set(Lexicon.load(path))
+    nltk_words = {word for word in words.words() if word == word.lower()}
+    return sorted(lexicon_words - nltk_words), sorted(nltk_words - lexicon_words)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the review collections.")
+    parser.add_argument("--collection", default="stage_thirty_reviews", help="Firestore collection to work on")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill-text-keys", help="Set the duplicate-detection key on existing documents")
+    subparsers.add_parser("backfill-random-keys", help="Set the sampling key on existing documents")
+    subparsers.add_parser("backfill-language-tags", help="Store the automatic language tags on existing documents")
+    subparsers.add_parser("migrate-language-tags", help="Convert reviewed language tags to the run-length encoded format")
+    subparsers.add_parser("rebuild-counters", help="Recompute the per-reviewer and per-status counters from scratch")
+    subparsers.add_parser("rebuild-summary", help="Recompute the sharded Analytics summary from scratch")
+    subparsers.add_parser("resync-mirror", help="Reload the local mirror (<collection>_mirror.sqlite) from scratch")
+    replay_parser = subparsers.add_parser("replay-journal", help="Apply review writes from the local journal that never reached Firestore")
+    replay_parser.add_argument("--journal", help="Path of the journal file (default: <collection>_journal.sqlite)")
+    lexicon_parser = subparsers.add_parser("build-lexicon", help="Rebuild the English word list light_tagger uses")
+    lexicon_parser.add_argument("--output", default=LEXICON_PATH, help="Path of the lexicon file to write")
+    lexicon_parser.add_argument("--source", choices=["web2", "nltk"], default="web2",
+                                help="Word list to build from: web2 from the english-words package (what the committed file uses) or the NLTK word corpus")
+    compare_parser = subparsers.add_parser("compare-lexicon", help="List the words light_tagger would tag differently with the lexicon file than with the NLTK word corpus")
+    compare_parser.add_argument("--lexicon", default=LEXICON_PATH, help="Path of the lexicon file to compare")
+    export_parser = subparsers.add_parser("export", help="Export approved and edited prompts to CSV, one row per uploaded prompt")
+    export_parser.add_argument("output_file", help="Path of the CSV file to write")
+    export_parser.add_argument("--include-pulled", action="store_true", help="Also export prompts already pulled into the speech app")
+    args = parser.parse_args()
+
+    if args.command == "backfill-text-keys":
+        count = backfill_text_keys(get_db(), args.collection)
+        print(f"Set text_key on {count} documents in {args.collection}")
+    elif args.command == "backfill-random-keys":
+        count = backfill_random_keys(get_db(), args.collection)
+        print(f"Set random_key on {count} documents in {args.collection}")
+    elif args.command == "backfill-language-tags":
+        count = backfill_language_tags(get_db(), args.collection)
+        print(f"Set auto_language_tags on {count} documents in {args.collection}")
+    elif args.command == "migrate-language-tags":
+        count, skipped = migrate_language_tags(get_db(), args.collection)
+        print(f"Converted the language tags of {count} documents in {args.collection}, left {skipped} whose tags don't match their text")
+    elif args.command == "rebuild-counters":
+        totals = rebuild_counters(get_db(), args.collection)
+        for (kind, name), total in sorted(totals.items()):
+            print(f"{kind} {name}: {total}")
+    elif args.command == "rebuild-summary":
+        counts = rebuild_summary(get_db(), args.collection)
+        print(f"Rebuilt the Analytics summary for {len(counts)} reviewers")
+    elif args.command == "resync-mirror":
+        count = ReviewMirror(f"{args.collection}_mirror.sqlite").sync(get_db(), args.collection, full=True)
+        print(f"Mirrored {count} documents from {args.collection}")
+    elif args.command == "replay-journal":
+        journal = ReviewJournal(args.journal or f"{args.collection}_journal.sqlite")
+        db = get_db()
+        applied, abandoned, remaining = replay(journal, review_writes(db, args.collection), stale_write_checks(db, args.collection))
+        print(f"Applied {applied} journal entries, abandoned {abandoned} overtaken by newer decisions, {remaining} still unapplied")
+    elif args.command == "build-lexicon":
+        count = build_english_lexicon(args.output, args.source)
+        print(f"Wrote {count} words to {args.output}")
+    elif args.command == "compare-lexicon":
+        only_lexicon, only_nltk = compare_lexicon_with_nltk(args.lexicon)
+        print(f"Source: {Lexicon.load(args.lexicon).source}")
+        print(f"{len(only_lexicon)} words only in the lexicon (tagged en, were yo): {' '.join(only_lexicon)}")
+        print(f"{len(only_nltk)} words only in the NLTK corpus (tagged yo, were en): {' '.join(only_nltk)}")
+    elif args.command == "export":
+        count = export_reviews(get_db(), args.collection, args.output_file, args.include_pulled)
+        print(f"Exported {count} prompts to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
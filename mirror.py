@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+# Fields analytics uses (plus the sync watermark); the rest of each document is not downloaded
+MIRROR_FIELDS = ["reviewer", "Status", "pulled", "Timestamp", "updated_at"]
+
+
+class ReviewMirror:
+    """
+    Local SQLite copy of the review state (reviewer, Status, pulled,
+    Timestamp) of a collection, for analytics.
+
+    The first sync copies the whole collection. Later syncs only fetch the
+    documents whose `updated_at` is at or after the newest one seen so far
+    (ties are fetched again rather than missed), so their cost follows the
+    number of changes rather than the collection size. `updated_at` is set by
+    the server when a write lands, unlike the Timestamp the client records, so
+    a write retried or replayed from the journal long after it was made is
+    still picked up.
+
+    Changes made outside these apps (deletions, `pulled` being set by the
+    speech app) don't set `updated_at` and are only picked up by a full resync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if "data" in [column[1] for column in self._conn.execute("PRAGMA table_info(docs)")]:
+            # Older mirrors also kept every document's fields as JSON; start over with a full sync without them
+            self._conn.execute("DROP TABLE docs")
+            self._conn.execute("DELETE FROM meta")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id TEXT PRIMARY KEY,
+                reviewer TEXT,
+                status TEXT,
+                pulled INTEGER NOT NULL DEFAULT 0,
+                timestamp TEXT
+            )
+        """)
+
+    def watermark(self):
+        """Returns the newest `updated_at` synced so far, or None before the first sync."""
+        # Mirrors from before `updated_at` kept a Timestamp watermark under another key; they start over with a full sync
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'updated_at_watermark'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def sync(self, db, collection, full=False):
+        """
+        Brings the mirror up to date with Firestore.
+
+        Parameters:
+            db: Firestore client.
+            collection (str): Name of the collection to mirror.
+            full (bool): Drop the local copy and load the whole collection again.
+
+        Returns:
+            int: Number of documents fetched.
+        """
+        with self._lock:
+            watermark = None if full else self.watermark()
+            query = db.collection(collection).select(MIRROR_FIELDS)
+            if watermark is None:
+                docs = query.stream()
+            else:
+                docs = query.where("updated_at", ">=", watermark).order_by("updated_at").stream()
+
+            rows = []
+            newest = watermark
+            for doc in docs:
+                data = doc.to_dict()
+                timestamp = data.get("Timestamp")
+                updated_at = data.get("updated_at")
+                if updated_at is not None and (newest is None or updated_at > newest):
+                    newest = updated_at
+                rows.append((
+                    doc.id,
+                    data.get("reviewer"),
+                    data.get("Status"),
+                    int(bool(data.get("pulled", False))),
+                    timestamp.isoformat() if timestamp is not None else None,
+                ))
+
+            if watermark is None and newest is None:
+                # Nothing carries `updated_at` yet; later syncs fetch whatever gets it from now on
+                newest = datetime.fromtimestamp(0, timezone.utc)
+
+            self._conn.execute("BEGIN")
+            if watermark is None:
+                self._conn.execute("DELETE FROM docs")
+            self._conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)", rows)
+            if newest is not None:
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('updated_at_watermark', ?)", (newest.isoformat(),))
+            self._conn.execute("COMMIT")
+            return len(rows)
+
+    def review_rows(self, include_pulled=False):
+        """
+        Lists (reviewer, Status, Timestamp) for every mirrored document.
+
+        Parameters:
+            include_pulled (bool): Also include documents already pulled into the speech app.
+
+        Returns:
+            list: Tuples of reviewer, status and ISO timestamp (or None).
+        """
+        query = "SELECT reviewer, status, timestamp FROM docs"
+        if not include_pulled:
+            query += " WHERE pulled = 0"
+        with self._lock:
+            return self._conn.execute(query).fetchall()
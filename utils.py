@@ -1,14 +1,16 @@
+import hashlib
+import itertools
+import random
+import unicodedata
+import numpy as np
+import pandas as pd
 import librosa
 from openai import OpenAI
 import sounddevice as sd
-import nltk
-from nltk.corpus import words
+from lexicon import load_english_words
 
-# Ensure that the NLTK word list is downloaded
-nltk.download('words')
-
-# Get the list of English words (using NLTK's word corpus)
-english_words = set(words.words())
+# Get the list of English words (from the prebuilt lexicon file, see `python manage.py build-lexicon`)
+english_words = load_english_words()
 
 
 
@@ -114,10 +116,157 @@ def light_tagger(text):
 
     return word_language_tags
 
+# Language codes the compact tag arrays from light_tagger_batch index into
+LANGUAGES = ("en", "yo")
+
+def light_tagger_batch(texts):
+    """
+    Tags many sentences at once, with the same result as `light_tagger` on each.
+
+    The words of all sentences are factorized as one column, and each distinct
+    word is cleaned and looked up in the English word list only once, so tagging
+    a whole upload costs one lookup per vocabulary word rather than per token.
+
+    Parameters:
+        texts (iterable): The sentences to tag.
+
+    Returns:
+        list: One numpy uint8 array per sentence, holding an index into LANGUAGES
+        for each word of `text.split()`. Use `expand_tags` to get (word, tag) pairs.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    lengths = np.fromiter((len(text.split()) for text in texts), dtype=np.int64, count=len(texts))
+
+    # Splitting the joined sentences gives every sentence's words back to back
+    codes, vocabulary = pd.factorize(np.array(" ".join(texts).split(), dtype=object))
+    is_english = np.fromiter(
+        (word.lower().strip(".,!?") in english_words for word in vocabulary),
+        dtype=bool,
+        count=len(vocabulary),
+    )
+
+    tags = np.where(is_english[codes], LANGUAGES.index("en"), LANGUAGES.index("yo")).astype(np.uint8)
+    return np.split(tags, np.cumsum(lengths)[:-1])
+
+def expand_tags(text, tags):
+    """
+    Pairs a sentence's words with a compact tag array from `light_tagger_batch`.
+
+    Parameters:
+        text (str): The sentence the tags were computed for.
+        tags (array): Indexes into LANGUAGES, one per word.
+
+    Returns:
+        list: (word, language) tuples, as returned by `light_tagger`.
+    """
+    return [(word, LANGUAGES[code]) for word, code in zip(text.split(), tags)]
+
+# Quote characters that copies of the same prompt get wrapped in
+QUOTE_TRANSLATION = str.maketrans({"\u201c": '"', "\u201d": '"', "\u201e": '"', "\u00ab": '"', "\u00bb": '"'})
+
+def normalize_text(text):
+    """
+    Puts a prompt in the canonical form used for duplicate detection.
+
+    Applies Unicode NFC composition (so Yoruba diacritics typed as combining
+    marks match their precomposed forms), collapses runs of whitespace and
+    strips the surrounding double quotes.
+
+    Parameters:
+        text (str): The prompt text.
+
+    Returns:
+        str: The canonical text.
+    """
+    text = unicodedata.normalize("NFC", str(text)).translate(QUOTE_TRANSLATION)
+    return " ".join(text.split()).strip('"').strip()
+
+def text_key(text):
+    """
+    Computes the duplicate-detection key stored on every document as `text_key`.
+
+    Parameters:
+        text (str): The prompt text.
+
+    Returns:
+        str: Hex SHA-1 digest of the normalized text.
+    """
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+# Function to build the document stored for an uploaded prompt, shared by every app's Upload Prompts page
+def prompt_document(data_row, member_ids, auto_tags):
+    """
+    Builds the Firestore document for one prompt of a processed upload file.
+
+    Parameters:
+        data_row (pd.Series): The prompt's row (ID, Original Text, code-switched-text, ...).
+        member_ids (list): IDs of every uploaded copy this document stands for.
+        auto_tags (np.ndarray): The prompt's tags from `light_tagger_batch`.
+
+    Returns:
+        dict: The document fields, including its text_key and random_key.
+    """
+    return {
+        "OriginalText": data_row["Original Text"],
+        "CodeSwitchedText": data_row["code-switched-text"],
+        "text_key": text_key(data_row["code-switched-text"]),
+        "auto_language_tags": [LANGUAGES[code] for code in auto_tags],
+        "CreatorName": data_row["Creator's Name"],
+        "Status": data_row["Status"],
+        "domain": data_row["domain"],
+        "pulled": data_row["pulled"],
+        "member_ids": member_ids,
+        "multiplicity": len(member_ids),
+        "random_key": random.random()  # Position used for uniform sampling of pending prompts
+    }
+
 # Function to convert a list of tuples into a list of dictionaries
 def tag(data):
     return [{"word": word, "language": language} for word, language in data]
 
 # Function to convert a list of dictionaries back into a list of tuples
 def reverse_tag(data):
-    return [(entry["word"], entry["language"]) for entry in data]
\ No newline at end of file
+    return [(entry["word"], entry["language"]) for entry in data]
+
+# Function to run-length encode the languages of a list of tuples, e.g. "en:3 yo:2" (the words are not stored)
+def encode_tags(data):
+    return " ".join(
+        f"{language}:{sum(1 for _ in run)}"
+        for language, run in itertools.groupby(language for _, language in data)
+    )
+
+# Function to pair the words of a text with run-length encoded languages back into a list of tuples.
+# Returns None when the runs don't cover exactly the words of the text (e.g. it was edited afterwards)
+def decode_tags(text, runs):
+    languages = []
+    for run in runs.split():
+        language, _, count = run.rpartition(":")
+        if not count.isdigit():
+            return None
+        languages.extend([language] * int(count))
+    words = text.split()
+    if len(languages) != len(words):
+        return None
+    return list(zip(words, languages))
+
+# Function to build the language tag fields of a review: run-length encoded over the words of the
+# reviewed text when the tags line up with them, in the legacy list of dictionaries otherwise
+def language_tag_fields(text, data):
+    # The other format is cleared so a document re-reviewed in a different format never keeps stale tags
+    if [word for word, _ in data] == text.split():
+        return {"language_tags_rle": encode_tags(data), "language_tags": None}
+    return {"language_tags_rle": None, "language_tags": tag(data)}
+
+# Function to read the language tags of a document as a list of tuples, whichever format they were stored in.
+# Documents whose stored tags are missing or don't fit the reviewed text get the automatic tags of that text
+def document_tags(data):
+    reviewed_text = data.get("reviewed_text") or ""
+    if data.get("language_tags_rle") is not None:
+        tags = decode_tags(reviewed_text, data["language_tags_rle"])
+        if tags is not None:
+            return tags
+    elif data.get("language_tags"):
+        return reverse_tag(data["language_tags"])
+    return light_tagger(reviewed_text)
\ No newline at end of file
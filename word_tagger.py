@@ -0,0 +1,37 @@
+import os
+import streamlit as st
+import streamlit.components.v1 as components
+
+# The frontend is a single static page, so no build step or dev server is needed
+_frontend_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "word_tagger_frontend")
+_word_tagger = components.declare_component("word_tagger", path=_frontend_dir)
+
+
+def word_tagger(word_tags, submit_label="Submit Review", key=None):
+    """
+    Displays a sentence as clickable words whose language tag (en/yo) is switched in the browser.
+
+    Clicking a word only recolors it on the page; nothing is sent to the server
+    until the reviewer presses the submit button, which returns every tag at once.
+
+    Parameters:
+        word_tags (list): (word, tag) pairs the sentence starts from.
+        submit_label (str): Text of the submit button under the sentence.
+        key (str): Widget key. Use a new key for a new sentence so the browser drops its edits.
+
+    Returns:
+        list: The (word, tag) pairs as submitted, on the rerun the submit button triggered. None otherwise.
+    """
+    value = _word_tagger(
+        words=[word for word, _ in word_tags],
+        tags=[tag for _, tag in word_tags],
+        submit_label=submit_label,
+        key=key,
+        default=None,
+    )
+
+    # The component keeps returning its last value on later reruns, so each submission is handled once
+    if value is None or st.session_state.get(f"{key}_handled") == value["submission"]:
+        return None
+    st.session_state[f"{key}_handled"] = value["submission"]
+    return [(word, tag) for word, tag in zip(value["words"], value["tags"])]